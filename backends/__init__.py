@@ -0,0 +1,72 @@
+"""
+Compute backends for the calculations in bond_calculations.py
+
+Every backend module implements the same functions, they take and return pandas
+dataframes so they can be swapped without changing the rest of the pipeline:
+
+- expenses_obligated(df) -> (df, pdf)
+- all_bond_expenses_obligated(df) -> df
+- monthly_expenses(df, xwalk) -> df
+
+pandas is the default, duckdb and polars run lazily on multiple threads and are
+only imported when they are selected.
+"""
+
+import importlib
+
+import pandas as pd
+
+BACKENDS = {
+    "pandas": "backends.pandas_backend",
+    "duckdb": "backends.duckdb_backend",
+    "polars": "backends.polars_backend",
+}
+
+
+def get_backend(name):
+    """
+    Returns the module implementing the given backend
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown compute backend: {name}, expected one of {list(BACKENDS)}")
+    return importlib.import_module(BACKENDS[name])
+
+
+def normalize(df):
+    # Row order and dtypes are allowed to differ between backends
+    df = df.reset_index()
+    df = df.sort_values(list(df.columns), ignore_index=True)
+    return df
+
+
+def check_parity(function, *args, backends=None):
+    """
+    Runs a backend function with every backend and checks that the outputs match pandas.
+
+    Parameters
+    ----------
+    function: Name of the backend function, ex: "expenses_obligated"
+    args: Pandas dataframes passed to the function, each backend gets its own copy
+    backends: list of backend names to compare to pandas, defaults to all of them
+
+    Returns: dict of backend name: output
+    -------
+    """
+    # pandas is the reference the other backends are compared to
+    names = list(backends or BACKENDS)
+    if "pandas" not in names:
+        names.insert(0, "pandas")
+
+    outputs = {}
+    for name in names:
+        backend = get_backend(name)
+        output = getattr(backend, function)(*[arg.copy() for arg in args])
+        outputs[name] = output if isinstance(output, tuple) else (output,)
+
+    expected = outputs["pandas"]
+    for name, output in outputs.items():
+        for left, right in zip(expected, output):
+            pd.testing.assert_frame_equal(
+                normalize(left), normalize(right), check_dtype=False
+            )
+    return outputs
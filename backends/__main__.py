@@ -0,0 +1,96 @@
+"""
+Checks that the compute backends give the same results as pandas on fixture
+frames shaped like the raw expense tables:
+
+    $ python -m backends [duckdb polars]
+"""
+
+import sys
+
+import numpy as np
+import pandas as pd
+
+from backends import check_parity, get_backend
+
+# department, fund, division, group
+GROUPS = [
+    (6200, "8xxx", "D1", "G1"),
+    (6200, "8yyy", "D2", "G2"),
+    (6300, "8zzz", "D3", "G3"),
+    (6400, "8www", "D4", "G4"),
+]
+
+
+def fiscal_years(dates):
+    return dates.year + (dates.month > 9)
+
+
+def fixture(rows=600, seed=0):
+    """
+    Returns: tuple of the 2020 bond raw table, the all bonds raw table, and the
+        AIMS -> Dashboard ID crosswalk
+    -------
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range("2021-08-01", "2023-03-31", freq="7D")
+    # Not every group has a row on every date, the backends fill those in
+    date = pd.DatetimeIndex(rng.choice(dates, rows))
+    group = rng.integers(len(GROUPS), size=rows)
+    expenses = np.round(rng.random(rows) * 100, 2)
+    obligated = np.round(rng.random(rows) * 100, 2)
+    # Some amounts are missing
+    expenses[rng.random(rows) < 0.05] = np.nan
+
+    columns = {
+        "department": [GROUPS[i][0] for i in group],
+        "date": date,
+        "obligated": obligated,
+        "expenses": expenses,
+        "updated_at": "2023-04-01 00:00:00+00:00",
+    }
+    bond_2020 = pd.DataFrame(
+        {
+            **columns,
+            "fund": [GROUPS[i][1] for i in group],
+            "division": [GROUPS[i][2] for i in group],
+            "group": [GROUPS[i][3] for i in group],
+            "fiscal_year": fiscal_years(date),
+        }
+    ).sort_values("date", kind="stable", ignore_index=True)
+    all_bonds = pd.DataFrame(
+        {
+            **columns,
+            "fund_code": [GROUPS[i][1] for i in group],
+            "division_code": [GROUPS[i][2] for i in group],
+            "group_code": [GROUPS[i][3] for i in group],
+        }
+    ).sort_values("date", kind="stable", ignore_index=True)
+
+    # The last group is not in the crosswalk and the first one is in it twice, only
+    # its first row is used
+    aims = [f"{d}{f}{v}{g}" for d, f, v, g in GROUPS]
+    xwalk = pd.DataFrame(
+        {
+            "aims_dept_prog_act": aims[:-1] + aims[:1],
+            "dashboard_deptfundprogact": ["DB0", "DB1", "DB0", "DB2"],
+        }
+    )
+    return bond_2020, all_bonds, xwalk
+
+
+def main(backends):
+    bond_2020, all_bonds, xwalk = fixture()
+
+    check_parity("expenses_obligated", bond_2020, backends=backends)
+    print("expenses_obligated: OK")
+    check_parity("all_bond_expenses_obligated", all_bonds, backends=backends)
+    print("all_bond_expenses_obligated: OK")
+
+    # monthly_expenses takes the output of expenses_obligated
+    expenses, _ = get_backend("pandas").expenses_obligated(bond_2020.copy())
+    check_parity("monthly_expenses", expenses, xwalk, backends=backends)
+    print("monthly_expenses: OK")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or None)
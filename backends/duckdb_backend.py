@@ -0,0 +1,158 @@
+"""
+DuckDB implementation of the bond calculations
+
+Queries run multi-threaded inside an in-memory DuckDB database and read the
+pandas dataframes in place, only the results are copied back to pandas.
+"""
+
+import duckdb
+import numpy as np
+
+from lookups import first_rows, report_unmapped, unmapped_keys
+
+
+def query(sql, **frames):
+    """
+    Runs a query against the given pandas dataframes and returns the result as a dataframe
+    """
+    con = duckdb.connect()
+    try:
+        for name, frame in frames.items():
+            con.register(name, frame)
+        df = con.sql(sql).df()
+    finally:
+        con.close()
+
+    # DuckDB returns nullable integer columns, pandas uses float64 when there are
+    # missing values and int64 otherwise
+    for col, dtype in df.dtypes.items():
+        if not isinstance(dtype, np.dtype) and dtype.kind in "iu":
+            df[col] = df[col].astype("float64" if df[col].isna().any() else "int64")
+    return df
+
+
+def with_row_number(df):
+    # Original row order, so ties on date keep the same order as pandas' stable sort
+    df = df.reset_index(drop=True)
+    df["_row"] = np.arange(len(df))
+    return df
+
+
+def expenses_obligated(df):
+    df = query(
+        """
+        WITH src AS (
+            SELECT *,
+                CAST("department" AS VARCHAR) || "fund" || "division" || "group" AS aims_dept_prog_act
+            FROM raw
+        ),
+        -- One row per FY, date, and AIMS DeptFundProgAct
+        filler AS (
+            SELECT f.fiscal_year, g.aims_dept_prog_act, d.date, 0.0 AS expenses, 0.0 AS obligated
+            FROM (SELECT DISTINCT fiscal_year FROM src) f
+            CROSS JOIN (SELECT DISTINCT "date" FROM src) d
+            CROSS JOIN (SELECT DISTINCT aims_dept_prog_act FROM src) g
+            ANTI JOIN src s
+                ON s.fiscal_year = f.fiscal_year
+                AND s.date = d.date
+                AND s.aims_dept_prog_act = g.aims_dept_prog_act
+        ),
+        rows AS (
+            SELECT * FROM src
+            UNION ALL BY NAME
+            SELECT * FROM filler
+        )
+        SELECT *,
+            -- Like pandas cumsum, a missing amount has a missing sum but is
+            -- skipped by the sums after it
+            CASE WHEN obligated IS NOT NULL THEN SUM(obligated) OVER w END AS sum_obligated,
+            CASE WHEN expenses IS NOT NULL THEN SUM(expenses) OVER w END AS sum_expenses
+        FROM rows
+        WINDOW w AS (
+            PARTITION BY aims_dept_prog_act, fiscal_year
+            ORDER BY "date", _row NULLS LAST
+            ROWS UNBOUNDED PRECEDING
+        )
+        ORDER BY "date", _row NULLS LAST
+        """,
+        raw=with_row_number(df),
+    )
+    df = df.drop(columns="_row")
+    df = df.set_index(df["date"].rename("datetime"))
+
+    # Export two versions, one for current FY and one for previous FY
+    pdf = df[df["fiscal_year"] < df["fiscal_year"].max()]
+
+    return df, pdf
+
+
+def all_bond_expenses_obligated(df):
+    df = query(
+        """
+        WITH src AS (
+            SELECT *,
+                CAST("department" AS VARCHAR) || "fund_code" || "division_code" || "group_code"
+                    AS aims_dept_prog_act
+            FROM raw
+            -- Only the first row for each AIMS DeptFundProgAct and date is kept
+            QUALIFY row_number() OVER (PARTITION BY aims_dept_prog_act, "date" ORDER BY _row) = 1
+        ),
+        -- One row per date and AIMS DeptFundProgAct
+        filler AS (
+            SELECT d.date, g.aims_dept_prog_act, 0.0 AS expenses, 0.0 AS obligated
+            FROM (SELECT DISTINCT "date" FROM src) d
+            CROSS JOIN (SELECT DISTINCT aims_dept_prog_act FROM src) g
+            ANTI JOIN src s
+                ON s.date = d.date
+                AND s.aims_dept_prog_act IS NOT DISTINCT FROM g.aims_dept_prog_act
+        ),
+        rows AS (
+            SELECT * FROM src
+            UNION ALL BY NAME
+            SELECT * FROM filler
+        )
+        SELECT *,
+            -- Like pandas cumsum, a missing amount has a missing sum but is
+            -- skipped by the sums after it
+            CASE WHEN obligated IS NOT NULL THEN SUM(obligated) OVER w END AS sum_obligated,
+            CASE WHEN expenses IS NOT NULL THEN SUM(expenses) OVER w END AS sum_expenses
+        FROM rows
+        WINDOW w AS (
+            PARTITION BY aims_dept_prog_act
+            ORDER BY "date", _row NULLS LAST
+            ROWS UNBOUNDED PRECEDING
+        )
+        ORDER BY "date", _row NULLS LAST
+        """,
+        raw=with_row_number(df),
+    )
+    df = df.drop(columns="_row")
+    df = df.set_index(df["date"].rename("datetime"))
+    return df
+
+
+def monthly_expenses(df, xwalk):
+    xwalk = first_rows(xwalk, "aims_dept_prog_act")
+    # These expenses are left out of the summary tables
+    report_unmapped(
+        "aims_dept_prog_act",
+        unmapped_keys(df["aims_dept_prog_act"], xwalk["aims_dept_prog_act"]),
+    )
+    df = query(
+        """
+        SELECT
+            year(e.date) AS year,
+            month(e.date) AS month,
+            x.dashboard_deptfundprogact,
+            e.fiscal_year,
+            SUM(e.expenses) AS expenses
+        FROM expenses e
+        LEFT JOIN xwalk x ON e.aims_dept_prog_act = x.aims_dept_prog_act
+        WHERE x.dashboard_deptfundprogact IS NOT NULL AND e.fiscal_year IS NOT NULL
+        GROUP BY ALL
+        ORDER BY ALL
+        """,
+        expenses=df[["date", "aims_dept_prog_act", "fiscal_year", "expenses"]].reset_index(drop=True),
+        xwalk=xwalk[["aims_dept_prog_act", "dashboard_deptfundprogact"]],
+    )
+    return df.set_index(["year", "month", "dashboard_deptfundprogact", "fiscal_year"])
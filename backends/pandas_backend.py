@@ -0,0 +1,164 @@
+"""
+pandas implementation of the bond calculations, this is the default backend
+"""
+
+import pandas as pd
+
+from lookups import Lookup, report_unmapped
+
+
+def expenses_obligated(df):
+    """
+    Generates the cumulative sum of the expenses and obligation data
+
+    Parameters
+    ----------
+    df : Pandas dataframe
+        Expenses and obligation data for the 2020 bond.
+
+    Returns
+    -------
+    Processed data with cumulative sum columns.
+
+    df : Pandas dataframe
+        Current FY
+    pdf : Pandas dataframe
+        Previous FY
+
+    """
+
+    # Lookup column we use is a concatenation of a few fields
+    df["aims_dept_prog_act"] = (
+        df["department"].astype(str) + df["fund"] + df["division"] + df["group"]
+    )
+
+    # Here, we are creating new rows in this dataset for the missing rows
+    # One row per FY, date, and AIMS DeptFundProgAct
+    # If we don't do this then the cumulative totals when summed will not be correct
+    fys = df["fiscal_year"].unique()
+    # Current fiscal year is determined based in the latest in our data
+    curr_year = fys.max()
+
+    dates = df["date"].unique()
+    groups = df["aims_dept_prog_act"].unique()
+    new_rows = []
+
+    for fy in fys:
+        for date in dates:
+            for group in groups:
+                if group not in list(
+                    df[(df["date"] == date) & (df["fiscal_year"] == fy)][
+                        "aims_dept_prog_act"
+                    ]
+                ):
+                    row = {
+                        "fiscal_year": fy,
+                        "aims_dept_prog_act": group,
+                        "date": date,
+                        "expenses": 0,
+                        "obligated": 0,
+                    }
+                    new_rows.append(row)
+
+    new_rows = pd.DataFrame(new_rows)
+    df = pd.concat([df, new_rows], ignore_index=True)
+
+    # Creating datetime index and sorting ascending by that
+    # The filler rows are appended at the end so we still need to sort once
+    df = df.set_index(df["date"].rename("datetime"))
+    df = df.sort_index(kind="stable")
+
+    # Cumulative sum is what is plotted in Power BI, we create a rolling total
+    # for each AIMS DeptFundProgAct and FY
+    df["sum_obligated"] = df.groupby(["aims_dept_prog_act", "fiscal_year"])[
+        "obligated"
+    ].cumsum()
+
+    df["sum_expenses"] = df.groupby(["aims_dept_prog_act", "fiscal_year"])[
+        "expenses"
+    ].cumsum()
+
+    # Export two versions, one for current FY and one for previous FY
+    pdf = df[df["fiscal_year"] < curr_year]
+
+    return df, pdf
+
+
+def all_bond_expenses_obligated(df):
+    # Lookup column we use is a concatenation of a few fields
+    df["aims_dept_prog_act"] = (
+        df["department"].astype(str)
+        + df["fund_code"]
+        + df["division_code"]
+        + df["group_code"]
+    )
+
+    # Here, we are creating new rows in this dataset for the missing rows
+    # One row per date and AIMS DeptFundProgAct
+    # If we don't do this then the cumulative totals when summed will not be correct
+
+    dates = df["date"].unique()
+    dates = pd.DataFrame(dates)
+    dates = dates.rename(columns={0: "date"})
+
+    groups = df["aims_dept_prog_act"].unique()
+    groups = pd.DataFrame(groups)
+    groups = groups.rename(columns={0: "aims_dept_prog_act"})
+
+    new_rows = dates.merge(groups, how="cross")
+    new_rows["expenses"] = 0
+    new_rows["obligated"] = 0
+    df = pd.concat([df, new_rows], ignore_index=True)
+    df = df.drop_duplicates(subset=["aims_dept_prog_act", "date"], keep="first")
+
+    # Creating datetime index and sorting ascending by that
+    # The filler rows are appended at the end so we still need to sort once
+    df = df.set_index(df["date"].rename("datetime"))
+    df = df.sort_index(kind="stable")
+
+    # Cumulative sum is what is plotted in Power BI, we create a rolling total
+    # for each AIMS DeptFundProgAct and FY
+    df["sum_obligated"] = df.groupby(["aims_dept_prog_act"])["obligated"].cumsum()
+
+    df["sum_expenses"] = df.groupby(["aims_dept_prog_act"])["expenses"].cumsum()
+
+    return df
+
+
+def monthly_expenses(df, xwalk):
+    """
+    Sums the 2020 bond expenses by year, month, Dashboard DeptFundProgAct, and FY
+
+    Parameters
+    ----------
+    df : Pandas dataframe
+        Output of expenses_obligated
+    xwalk : Pandas dataframe
+        AIMS -> Dashboard ID lookup table
+
+    Returns
+    -------
+    Pandas dataframe of the expenses indexed by year, month, dashboard_deptfundprogact
+    and fiscal_year
+
+    """
+    # Need to convert from DeptFundProgAct to Dashboard DeptFundProgAct first
+    xwalk = Lookup(xwalk, "aims_dept_prog_act")
+    positions = xwalk.positions(df["aims_dept_prog_act"])
+    # These expenses are left out of the summary tables
+    report_unmapped("aims_dept_prog_act", xwalk.unmapped(df["aims_dept_prog_act"], positions))
+    df = df[["date", "fiscal_year", "expenses"]].assign(
+        dashboard_deptfundprogact=xwalk.take(positions, "dashboard_deptfundprogact")
+    )
+
+    # date is already datetime64 so there is no need to re-parse or re-sort here
+    df = df.groupby(
+        [
+            df["date"].dt.year.rename("year"),
+            df["date"].dt.month.rename("month"),
+            "dashboard_deptfundprogact",
+            "fiscal_year",
+        ]
+    )[["expenses"]].sum()
+
+    return df
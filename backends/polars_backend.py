@@ -0,0 +1,125 @@
+"""
+Polars implementation of the bond calculations
+
+The calculations are built as lazy queries, polars optimizes and runs them on
+multiple threads when they are collected.
+"""
+
+import polars as pl
+
+from lookups import first_rows, report_unmapped, unmapped_keys
+
+
+def expenses_obligated(df):
+    src = (
+        pl.from_pandas(df.reset_index(drop=True))
+        .lazy()
+        .with_row_index("_row")
+        .with_columns(
+            pl.concat_str(
+                pl.col("department").cast(pl.Utf8),
+                pl.col("fund"),
+                pl.col("division"),
+                pl.col("group"),
+            ).alias("aims_dept_prog_act")
+        )
+    )
+
+    # One row per FY, date, and AIMS DeptFundProgAct
+    filler = (
+        src.select("fiscal_year").unique()
+        .join(src.select("date").unique(), how="cross")
+        .join(src.select("aims_dept_prog_act").unique(), how="cross")
+        .join(src, on=["fiscal_year", "date", "aims_dept_prog_act"], how="anti")
+        .with_columns(expenses=pl.lit(0.0), obligated=pl.lit(0.0))
+    )
+
+    group = ["aims_dept_prog_act", "fiscal_year"]
+    df = (
+        pl.concat([src, filler], how="diagonal_relaxed")
+        .sort(["date", "_row"], nulls_last=True)
+        .with_columns(
+            sum_obligated=pl.col("obligated").cum_sum().over(group),
+            sum_expenses=pl.col("expenses").cum_sum().over(group),
+        )
+        .drop("_row")
+        .collect()
+        .to_pandas()
+    )
+    df = df.set_index(df["date"].rename("datetime"))
+
+    # Export two versions, one for current FY and one for previous FY
+    pdf = df[df["fiscal_year"] < df["fiscal_year"].max()]
+
+    return df, pdf
+
+
+def all_bond_expenses_obligated(df):
+    src = (
+        pl.from_pandas(df.reset_index(drop=True))
+        .lazy()
+        .with_row_index("_row")
+        .with_columns(
+            pl.concat_str(
+                pl.col("department").cast(pl.Utf8),
+                pl.col("fund_code"),
+                pl.col("division_code"),
+                pl.col("group_code"),
+            ).alias("aims_dept_prog_act")
+        )
+        # Only the first row for each AIMS DeptFundProgAct and date is kept
+        .unique(subset=["aims_dept_prog_act", "date"], keep="first", maintain_order=True)
+    )
+
+    # One row per date and AIMS DeptFundProgAct
+    filler = (
+        src.select("date").unique()
+        .join(src.select("aims_dept_prog_act").unique(), how="cross")
+        .join(src, on=["date", "aims_dept_prog_act"], how="anti", nulls_equal=True)
+        .with_columns(expenses=pl.lit(0.0), obligated=pl.lit(0.0))
+    )
+
+    df = (
+        pl.concat([src, filler], how="diagonal_relaxed")
+        .sort(["date", "_row"], nulls_last=True)
+        .with_columns(
+            sum_obligated=pl.col("obligated").cum_sum().over("aims_dept_prog_act"),
+            sum_expenses=pl.col("expenses").cum_sum().over("aims_dept_prog_act"),
+        )
+        .drop("_row")
+        .collect()
+        .to_pandas()
+    )
+    df = df.set_index(df["date"].rename("datetime"))
+    return df
+
+
+def monthly_expenses(df, xwalk):
+    expenses = pl.from_pandas(
+        df[["date", "aims_dept_prog_act", "fiscal_year", "expenses"]].reset_index(drop=True)
+    ).lazy()
+    xwalk = first_rows(xwalk, "aims_dept_prog_act")
+    # These expenses are left out of the summary tables
+    report_unmapped(
+        "aims_dept_prog_act",
+        unmapped_keys(df["aims_dept_prog_act"], xwalk["aims_dept_prog_act"]),
+    )
+    xwalk = pl.from_pandas(
+        xwalk[["aims_dept_prog_act", "dashboard_deptfundprogact"]].reset_index(drop=True)
+    ).lazy()
+
+    keys = ["year", "month", "dashboard_deptfundprogact", "fiscal_year"]
+    df = (
+        expenses.join(xwalk, on="aims_dept_prog_act", how="left")
+        .with_columns(
+            year=pl.col("date").dt.year().cast(pl.Int64),
+            month=pl.col("date").dt.month().cast(pl.Int64),
+        )
+        .drop_nulls(["dashboard_deptfundprogact", "fiscal_year"])
+        .group_by(keys)
+        .agg(pl.col("expenses").sum())
+        .sort(keys)
+        .collect()
+        .to_pandas()
+    )
+    return df.set_index(keys)
@@ -4,7 +4,11 @@ import os
 import pandas as pd
 from pypgrest import Postgrest
 from sodapy import Socrata
-import numpy as np
+
+from backends import get_backend
+from lookups import Lookup
+import offline
+from payloads import iter_json
 
 # Postgest Credentials
 POSTGREST_ENDPOINT = os.getenv("POSTGREST_ENDPOINT")
@@ -16,6 +20,10 @@ SO_TOKEN = os.getenv("SO_TOKEN")
 SO_KEY = os.getenv("SO_KEY")
 SO_SECRET = os.getenv("SO_SECRET")
 DATE_FORMAT_SOCRATA = "%Y-%m-%dT00:00:00.000"
+DATE_FORMAT_POSTGREST = "%Y-%m-%d"
+
+# Compute backend used for the calculations: pandas (default), duckdb or polars
+BACKEND = os.getenv("COMPUTE_BACKEND", "pandas")
 
 # Used for converting numeric months into sortable strings in Power BI
 MONTH_NAMES = {
@@ -33,24 +41,45 @@ MONTH_NAMES = {
     12: "12",
 }
 
-def get_data(client, table):
+# Order the rows of a table are read in, other than "date,updated_at". Every row of a
+# load has the same updated_at, all_bond_expenses_obligated keeps the first row of a
+# group and date so its duplicates are ordered by all of their columns to always keep
+# the same one. api.raw_totals in bond_tables.sql uses the same order.
+ROW_ORDER = {
+    "expenses_obligated_all_bonds_raw": "date,updated_at,expenses,obligated,"
+    "fund_long_name,division_long_name,department_long_name,group_long_name",
+}
+
+def get_data(client, table, date_field=False):
     """
 
     Parameters
     ----------
     client - Postgrest client
     table - Name of the table in the Postgrest database
+    date_field - True if this table has a "date" column. It is parsed once here
+        into datetime64 and the rows come back sorted by it, see ROW_ORDER.
 
     Returns
     -------
     A pandas dataframe of the whole table
 
     """
-    params = {"select": "*", "order": "updated_at"}
+    # The worker keeps the parsed tables in memory between refreshes (see worker.py)
+    if hasattr(client, "get_data"):
+        return client.get_data(table, date_field)
+
+    if date_field:
+        params = {"select": "*", "order": ROW_ORDER.get(table, "date,updated_at")}
+    else:
+        params = {"select": "*", "order": "updated_at"}
     res = client.select(resource=table, params=params)
-    return pd.DataFrame(res)
+    df = pd.DataFrame(res)
+    if date_field:
+        df["date"] = pd.to_datetime(df["date"], format=DATE_FORMAT_POSTGREST)
+    return df
 
-def expenses_obligated(df):
+def expenses_obligated(df, backend=BACKEND):
     """
     Generates the cumulative sum of the expenses and obligation data
 
@@ -58,6 +87,8 @@ def expenses_obligated(df):
     ----------
     df : Pandas dataframe
         Expenses and obligation data for the 2020 bond.
+    backend : str
+        Name of the compute backend, see backends/__init__.py
 
     Returns
     -------
@@ -69,103 +100,13 @@ def expenses_obligated(df):
         Previous FY
 
     """
+    return get_backend(backend).expenses_obligated(df)
 
-    # Lookup column we use is a concatenation of a few fields
-    df["aims_dept_prog_act"] = (
-        df["department"].astype(str) + df["fund"] + df["division"] + df["group"]
-    )
-
-    # Here, we are creating new rows in this dataset for the missing rows
-    # One row per FY, date, and AIMS DeptFundProgAct
-    # If we don't do this then the cumulative totals when summed will not be correct
-    fys = df["fiscal_year"].unique()
-    # Current fiscal year is determined based in the latest in our data
-    curr_year = fys.max()
-
-    dates = df["date"].unique()
-    groups = df["aims_dept_prog_act"].unique()
-    new_rows = []
-
-    for fy in fys:
-        for date in dates:
-            for group in groups:
-                if group not in list(
-                    df[(df["date"] == date) & (df["fiscal_year"] == fy)][
-                        "aims_dept_prog_act"
-                    ]
-                ):
-                    row = {
-                        "fiscal_year": fy,
-                        "aims_dept_prog_act": group,
-                        "date": date,
-                        "expenses": 0,
-                        "obligated": 0,
-                    }
-                    new_rows.append(row)
-
-    new_rows = pd.DataFrame(new_rows)
-    df = pd.concat([df, new_rows], ignore_index=True)
-
-    # Creating datetime index and sorting ascending by that
-    df["datetime"] = pd.to_datetime(df["date"])
-    df = df.set_index("datetime")
-    df = df.sort_index()
-
-    # Cumulative sum is what is plotted in Power BI, we create a rolling total
-    # for each AIMS DeptFundProgAct and FY
-    df["sum_obligated"] = df.groupby(["aims_dept_prog_act", "fiscal_year"])[
-        "obligated"
-    ].cumsum()
-
-    df["sum_expenses"] = df.groupby(["aims_dept_prog_act", "fiscal_year"])[
-        "expenses"
-    ].cumsum()
-
-    # Export two versions, one for current FY and one for previous FY
-    pdf = df[df["fiscal_year"] < curr_year]
-
-    return df, pdf
-
-
-def all_bond_expenses_obligated(df):
-    # Lookup column we use is a concatenation of a few fields
-    df["aims_dept_prog_act"] = (
-        df["department"].astype(str)
-        + df["fund_code"]
-        + df["division_code"]
-        + df["group_code"]
-    )
-
-    # Here, we are creating new rows in this dataset for the missing rows
-    # One row per date and AIMS DeptFundProgAct
-    # If we don't do this then the cumulative totals when summed will not be correct
-
-    dates = df["date"].unique()
-    dates = pd.DataFrame(dates)
-    dates = dates.rename(columns={0: "date"})
 
-    groups = df["aims_dept_prog_act"].unique()
-    groups = pd.DataFrame(groups)
-    groups = groups.rename(columns={0: "aims_dept_prog_act"})
-
-    new_rows = dates.merge(groups, how="cross")
-    new_rows["expenses"] = 0
-    new_rows["obligated"] = 0
-    df = pd.concat([df, new_rows], ignore_index=True)
-    df = df.drop_duplicates(subset=["aims_dept_prog_act", "date"], keep="first")
-
-    # Creating datetime index and sorting ascending by that
-    df["datetime"] = pd.to_datetime(df["date"])
-    df = df.set_index("datetime")
-    df = df.sort_index()
-
-    # Cumulative sum is what is plotted in Power BI, we create a rolling total
-    # for each AIMS DeptFundProgAct and FY
-    df["sum_obligated"] = df.groupby(["aims_dept_prog_act"])["obligated"].cumsum()
-
-    df["sum_expenses"] = df.groupby(["aims_dept_prog_act"])["expenses"].cumsum()
-
-    return df
+def all_bond_expenses_obligated(df, backend=BACKEND):
+    # Same as expenses_obligated but for all bonds, the cumulative sums are not
+    # split by fiscal year
+    return get_backend(backend).all_bond_expenses_obligated(df)
 
 
 def fiscal_year(row):
@@ -185,24 +126,10 @@ def group_table(row, fiscal_year):
     return f"0FY {str(row['group'][3])[2:4]}"
 
 
-def summarize_expenses(df, fy, client):
-
-    # Need to convert from DeptFundProgAct to Dashboard DeptFundProgAct first
-    # AIMS -> Dashboard ID lookup table
-    xwalk = get_data(client, "bond_2020_aims_to_dashboard")
-    #xwalk = xwalk.rename(columns={"AIMS Dept Prog Act": "AIMS DeptFundProgAct"})
-
-    df = pd.merge(df, xwalk, on="aims_dept_prog_act", how="left")
-
-    # Setting datetime index again
-    df["datetime"] = pd.to_datetime(df["date"])
-    df = df.set_index("datetime")
-    df = df.sort_index()
-
-    # Summarizing our expenses data by year, month, Dashboard DeptFundProgAct, and FY
-    df = df.groupby(
-        [df.index.year, df.index.month, "dashboard_deptfundprogact", "fiscal_year"]
-    ).sum(numeric_only=True)
+def summarize_expenses(df, fy):
+    # df is our expenses data summarized by year, month, Dashboard DeptFundProgAct,
+    # and FY (see monthly_expenses in the backends), it is the same for every fy
+    df = df.copy()
 
     # Creates a group column that allows us to access it inside other functions
     df["group"] = df.index.to_series()
@@ -224,12 +151,14 @@ def group_plans(row, fiscal_year):
 
 def determine_fy(client):
     # Looks at the current year spend plan and returns the maximum fiscal year
-    df = get_data(client, "bond_2020_current_fy_spend_plan")
-    df["datetime"] = pd.to_datetime(df["date"])
-    df = df.set_index("datetime")
-    df = df.sort_index()
-
-    df = df.groupby([df.index.year, df.index.month, "dashboard_deptfundprogact"]).sum(numeric_only=True)
+    df = get_data(client, "bond_2020_current_fy_spend_plan", date_field=True)
+    df = df.groupby(
+        [
+            df["date"].dt.year.rename("year"),
+            df["date"].dt.month.rename("month"),
+            "dashboard_deptfundprogact",
+        ]
+    ).sum(numeric_only=True)
 
     df["group"] = df.index.to_series()
 
@@ -238,13 +167,15 @@ def determine_fy(client):
 
 
 def summarize_plans(file, fy, client):
-    df = get_data(client, file)
+    df = get_data(client, file, date_field=True)
 
-    df["datetime"] = pd.to_datetime(df["date"])
-    df = df.set_index("datetime")
-    df = df.sort_index()
-
-    df = df.groupby([df.index.year, df.index.month, "dashboard_deptfundprogact"]).sum(numeric_only=True)
+    df = df.groupby(
+        [
+            df["date"].dt.year.rename("year"),
+            df["date"].dt.month.rename("month"),
+            "dashboard_deptfundprogact",
+        ]
+    ).sum(numeric_only=True)
 
     df["group"] = df.index.to_series()
 
@@ -254,7 +185,12 @@ def summarize_plans(file, fy, client):
     df = df.groupby(["table_col", "dashboard_deptfundprogact"]).sum(numeric_only=True)
     return df
 
-def summary_table(expenses, fiscal_year,client):
+def summary_table(expenses, fiscal_year, client, backend=BACKEND):
+    # Need to convert from DeptFundProgAct to Dashboard DeptFundProgAct first
+    # AIMS -> Dashboard ID lookup table
+    xwalk = get_data(client, "bond_2020_aims_to_dashboard")
+    monthly = get_backend(backend).monthly_expenses(expenses, xwalk)
+
     dfs = []
     for i in range(-1, 1):
         fy = fiscal_year + i
@@ -263,7 +199,7 @@ def summary_table(expenses, fiscal_year,client):
         else:
             spend_plan = "bond_2020_current_fy_spend_plan"
 
-        expenses_summary = summarize_expenses(expenses, fy, client)
+        expenses_summary = summarize_expenses(monthly, fy)
         expenses_summary = expenses_summary.groupby(["table_col", "dashboard_deptfundprogact"]).sum(numeric_only=True)
         expenses_summary = expenses_summary.rename(columns={"expenses": "Expenses"})
 
@@ -294,35 +230,67 @@ def summary_table(expenses, fiscal_year,client):
 
     return dfs[0], dfs[1]
 
+def program_metadata(programs, appropriations):
+    """
+    Joins the appropriation totals to the all bonds program names
+
+    Parameters
+    ----------
+    programs : Pandas dataframe
+        all_bonds_program_names
+    appropriations : Pandas dataframe
+        all_bonds_appropriations, one row per appropriation
+
+    Returns
+    -------
+    programs with an appropriated column, missing if the program has no appropriations
+
+    """
+    totals = appropriations.groupby("dashboard_deptfundprogact", as_index=False)[
+        "amount"
+    ].sum()
+    totals = Lookup(totals, "dashboard_deptfundprogact")
+    positions = totals.positions(programs["dashboard_deptfundprogact"])
+    programs["appropriated"] = totals.take(positions, "amount")
+    return programs
+
 def df_to_socrata(soda, df, dataset_id,date_field=False, include_index=False):
-    if date_field:
-        df["date"] = pd.to_datetime(df["date"], infer_datetime_format=True)
-        df["date"] = df["date"].dt.strftime(DATE_FORMAT_SOCRATA)
-    if include_index:
-        df = df.reset_index()
-    df = df.replace({np.nan: None})
-    payload = df.to_dict(orient="records")
-    try:
-        res = soda.replace(dataset_id, payload)
-    except Exception as e:
-        raise e
-
-def main():
-    client = Postgrest(
-        POSTGREST_ENDPOINT,
-        token=POSTGREST_TOKEN,
-        headers={"Prefer": "return=representation"},
+    # Dates stay datetime64 in our dataframes, they are only formatted as the
+    # payload is serialized so the caller's df can keep being used for calculations
+    date_format = DATE_FORMAT_SOCRATA if date_field else "%Y-%m-%dT%H:%M:%S"
+    body = iter_json(df, date_format=date_format, include_index=include_index)
+
+    # Equivalent to soda.replace() but the JSON is streamed in chunks as the request
+    # body instead of being built as a list of dicts first
+    url = f"{soda.uri_prefix}{soda.domain}/resource/{dataset_id}.json"
+    res = soda.session.put(
+        url,
+        data=body,
+        headers={"Content-Type": "application/json"},
+        timeout=soda.timeout,
     )
+    res.raise_for_status()
+    return res.json()
+
+def main(client=None, soda=None):
+    # Clients can be passed in to reuse them between stages (see bond_reporting.py)
+    if client is None:
+        client = Postgrest(
+            POSTGREST_ENDPOINT,
+            token=POSTGREST_TOKEN,
+            headers={"Prefer": "return=representation"},
+        )
 
     # Socrata client
-    soda = Socrata(SO_WEB, SO_TOKEN, username=SO_KEY, password=SO_SECRET, timeout=500, )
+    if soda is None:
+        soda = Socrata(SO_WEB, SO_TOKEN, username=SO_KEY, password=SO_SECRET, timeout=500, )
 
     # Data from Microstrategy is in S3
     # 2020 Bond Expenses Obligated.csv
-    bond_data_2020 = get_data(client, "expenses_obligated_2020_bond_raw")
+    bond_data_2020 = get_data(client, "expenses_obligated_2020_bond_raw", date_field=True)
     bond_data_2020, py_bond_data_2020 = expenses_obligated(bond_data_2020)
 
-    all_bond_data = get_data(client, "expenses_obligated_all_bonds_raw")
+    all_bond_data = get_data(client, "expenses_obligated_all_bonds_raw", date_field=True)
 
     all_bond_data = all_bond_expenses_obligated(all_bond_data)
 
@@ -346,9 +314,7 @@ def main():
 
     # Join in the appropriation totals
     app = get_data(client, "all_bonds_appropriations")
-    app = app.pivot_table(index="dashboard_deptfundprogact", values="amount", aggfunc=sum)
-    df = df.merge(app, on="dashboard_deptfundprogact", how="left")
-    df = df.rename(columns={"amount": "appropriated"})
+    df = program_metadata(df, app)
     df_to_socrata(soda, df, "9ufs-k2md")
 
     # Upload all bonds ID lookup table to socrata
@@ -356,4 +322,5 @@ def main():
     df_to_socrata(soda, df, "mri6-eexh")
 
 if __name__ == "__main__":
+    offline.install()
     main()
@@ -1,9 +1,15 @@
-from config.csv_config import CSVS
+from config.csv_config import CSVS, build_schema
+from payloads import iter_json
+import offline
 
 import boto3
 import pandas as pd
 from pypgrest import Postgrest
+import requests
 
+from itertools import chain
+import io
+import json
 import os
 
 POSTGREST_ENDPOINT = os.getenv("POSTGREST_ENDPOINT")
@@ -11,6 +17,11 @@ POSTGREST_TOKEN = os.getenv("POSTGREST_TOKEN")
 AWS_ACCESS_ID = os.getenv("AWS_ACCESS_ID")
 AWS_PASS = os.getenv("AWS_PASS")
 BUCKET = os.getenv("BUCKET")
+DATE_FORMAT_POSTGRES = "%Y-%m-%d"
+# Seconds to wait for postgrest to respond to an insert or RPC call
+POSTGREST_TIMEOUT = int(os.getenv("POSTGREST_TIMEOUT", 300))
+# Seconds to wait for a Google Sheet CSV to download
+CSV_TIMEOUT = 60
 
 
 def field_mapping(df, maps):
@@ -37,7 +48,8 @@ def field_mapping(df, maps):
 
 
 def convert_datetime(df, col):
-    df[col] = pd.to_datetime(df[col], format="%m/%d/%Y").astype(str)
+    # Parsed once at ingest, dates stay datetime64 until they are sent to postgres
+    df[col] = pd.to_datetime(df[col], format="%m/%d/%Y")
     return df
 
 
@@ -48,61 +60,141 @@ def validate_schema(df, schema):
     Parameters
     ----------
     df: Pandas dataframe that you are validating
-    schema: pandera DataFrameSchema object for the provided table
+    schema: "schema" config of the table, see config.csv_config.build_schema
 
     Returns: The same df back or will raise an error if it does not align with schema
     -------
 
     """
-    df = schema.validate(df)
+    df = build_schema(schema).validate(df)
     return df
 
 
-def to_postgres(client, df, table):
+def read_table(table, s3_client):
+    """
+    Reads a CSV and prepares it to be sent to its postgres table
+
+    Parameters
+    ----------
+    table: dict of the CSV's config, see config/csv_config.py
+    s3_client: boto3 S3 client
+
+    Returns: validated df with the table's columns
+    -------
+    """
+    if table["boto3"]:
+        # Flag to use boto3 to read our CSV from S3
+        response = s3_client.get_object(
+            Bucket="atd-microstrategy-reports", Key=table["url"]
+        )
+        df = pd.read_csv(response.get("Body"))
+    else:
+        # Downloaded with requests rather than by pandas so that offline.py records
+        # and replays the Google Sheets like the other HTTP calls
+        res = requests.get(table["url"], timeout=CSV_TIMEOUT)
+        res.raise_for_status()
+        df = pd.read_csv(io.BytesIO(res.content))
+    df = field_mapping(df, table["field_maps"])
+    if table["date_field"]:
+        df = convert_datetime(df, "date")
+    df = validate_schema(df, table["schema"])
+    return df
+
+
+def postgrest_session(client):
+    """
+    Returns the requests session kept on the Postgrest client, pypgrest opens a new
+    session for every request so ours is shared by the inserts and RPC calls
+    """
+    if getattr(client, "session", None) is None:
+        client.session = requests.Session()
+    return client.session
+
+
+def postgrest_post(client, resource, data):
+    """
+    POSTs to the client's postgrest endpoint with its token, without sending the
+    rows back (Prefer: return=minimal)
+    """
+    headers = {**client.default_headers, "Prefer": "return=minimal"}
+    res = postgrest_session(client).post(
+        f"{client.url.rstrip('/')}/{resource}",
+        data=data,
+        headers=headers,
+        timeout=POSTGREST_TIMEOUT,
+    )
+    res.raise_for_status()
+    return res
+
+
+def insert(client, df, table):
+    # Send df to database, the JSON payload is streamed to postgrest in chunks.
+    # Dates are only formatted as strings here, at the postgrest boundary
+    body = iter_json(df, date_format=DATE_FORMAT_POSTGRES)
+    return postgrest_post(client, table, body)
+
+
+def to_postgres(client, df, table, swap=False):
+    """
+    Replaces the data in a postgres table with df
+
+    Parameters
+    ----------
+    client: Postgrest client
+    df: Pandas dataframe of the new data
+    table: Name of the table in the database
+    swap: True if the table has a _staging table that the new data is loaded into
+        and then swapped with the live table (api.load_raw). Otherwise the outdated
+        rows are deleted.
+
+    Returns: Response of the last request
+    -------
+    """
     # Creating updated_at column
     time = pd.to_datetime("now", utc=True)
     df["updated_at"] = str(time)
 
-    # Send df to database
-    payload = df.to_dict(orient="records")
     try:
-        # Insert updated data
-        res = client.insert(resource=table, data=payload)
-        # Now delete outdated data
-        params = {"select": "*", "updated_at": f"lt.{time}", "order": "updated_at"}
-        res = client.delete(resource=table, params=params)
-    except Exception as e:
-        raise e.response.text
+        if swap:
+            # One RPC so the load and the swap are a single transaction, the rows
+            # are streamed inside the JSON body of the call
+            body = chain(
+                [b'{"target":' + json.dumps(table).encode() + b',"rows":'],
+                iter_json(df, date_format=DATE_FORMAT_POSTGRES),
+                [b"}"],
+            )
+            res = postgrest_post(client, "rpc/load_raw", body)
+        else:
+            # Insert updated data
+            insert(client, df, table)
+            # Now delete outdated data
+            params = {"select": "*", "updated_at": f"lt.{time}", "order": "updated_at"}
+            res = client.delete(resource=table, params=params)
+    except requests.exceptions.HTTPError as e:
+        raise Exception(e.response.text) from e
     return res
 
 
-def main():
-    client = Postgrest(
-        POSTGREST_ENDPOINT,
-        token=POSTGREST_TOKEN,
-        headers={"Prefer": "return=representation"},
-    )
-    s3_client = boto3.client(
-        "s3",
-        aws_access_key_id=AWS_ACCESS_ID,
-        aws_secret_access_key=AWS_PASS,
-    )
+def main(client=None, s3_client=None):
+    # Clients can be passed in to reuse them between stages (see bond_reporting.py)
+    if client is None:
+        client = Postgrest(
+            POSTGREST_ENDPOINT,
+            token=POSTGREST_TOKEN,
+            headers={"Prefer": "return=representation"},
+        )
+    if s3_client is None:
+        s3_client = boto3.client(
+            "s3",
+            aws_access_key_id=AWS_ACCESS_ID,
+            aws_secret_access_key=AWS_PASS,
+        )
 
     for table in CSVS:
-        if table["boto3"]:
-            # Flag to use boto3 to read our CSV from S3
-            response = s3_client.get_object(
-                Bucket="atd-microstrategy-reports", Key=table["url"]
-            )
-            df = pd.read_csv(response.get("Body"))
-        else:
-            df = pd.read_csv(table["url"])
-        df = field_mapping(df, table["field_maps"])
-        if table["date_field"]:
-            df = convert_datetime(df, "date")
-        df = validate_schema(df, table["schema"])
-        res = to_postgres(client, df, table["table"])
+        df = read_table(table, s3_client)
+        res = to_postgres(client, df, table["table"], table["swap"])
 
 
 if __name__ == "__main__":
+    offline.install()
     main()
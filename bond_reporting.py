@@ -0,0 +1,328 @@
+"""
+Single entry point for the bond reporting ETL.
+
+Runs the stages of the ETL as subcommands in one process:
+
+- extract: microstrategy_to_s3.py, Microstrategy reports -> S3
+- load: bond_data.py, CSVs -> postgres
+- calculate: bond_calculations.py, postgres -> Socrata
+- all: all of the above, in order
+- reconcile: reconcile.py, checks that S3, postgres, and Socrata match
+- worker: worker.py, keeps running and refreshes the dashboard on a schedule
+- bench: import time of each subcommand, measured with python -X importtime
+
+The stage modules (and pandas, mstrio, boto3, etc.) are only imported when a
+subcommand needs them, and the API clients are shared between stages.
+"""
+
+# Standard Library imports only, everything else is imported lazily
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+# Modules each subcommand needs
+STAGES = {
+    "extract": ["microstrategy_to_s3"],
+    "load": ["bond_data"],
+    "calculate": ["bond_calculations"],
+    "all": ["microstrategy_to_s3", "bond_data", "bond_calculations"],
+    "reconcile": ["reconcile"],
+    "worker": ["worker"],
+}
+
+# Lines printed to stderr by python -X importtime
+IMPORT_TIME = re.compile(r"import time:\s+\d+ \|\s+(\d+) \| ( *)(\S+)")
+
+
+# API clients each subcommand uses
+STAGE_CLIENTS = {
+    "extract": ["mstro", "s3"],
+    "load": ["postgrest", "s3"],
+    "calculate": ["postgrest", "soda"],
+    "all": ["mstro", "s3", "postgrest", "soda"],
+    "reconcile": ["postgrest", "s3", "soda"],
+    "worker": ["postgrest", "s3", "soda"],
+}
+
+
+class Clients:
+    """
+    Creates the API clients the first time a stage needs them, then keeps them
+    alive for the next stages.
+
+    The credentials are read from the environment here so building a client only
+    imports its own library, not the stage modules (and mstrio, pandas, etc.).
+    """
+
+    def __init__(self):
+        self._s3 = None
+        self._mstro = None
+        self._postgrest = None
+        self._soda = None
+
+    @property
+    def s3(self):
+        # boto3 S3 resource, its .meta.client is used where a client is expected
+        if self._s3 is None:
+            import boto3
+
+            session = boto3.Session(
+                aws_access_key_id=os.getenv("AWS_ACCESS_ID"),
+                aws_secret_access_key=os.getenv("AWS_PASS"),
+            )
+            self._s3 = session.resource("s3")
+        return self._s3
+
+    @property
+    def mstro(self):
+        if self._mstro is None:
+            from microstrategy_to_s3 import connect_to_mstro
+
+            self._mstro = connect_to_mstro()
+        return self._mstro
+
+    @property
+    def postgrest(self):
+        if self._postgrest is None:
+            from pypgrest import Postgrest
+
+            self._postgrest = Postgrest(
+                os.getenv("POSTGREST_ENDPOINT"),
+                token=os.getenv("POSTGREST_TOKEN"),
+                headers={"Prefer": "return=representation"},
+            )
+        return self._postgrest
+
+    @property
+    def soda(self):
+        if self._soda is None:
+            from sodapy import Socrata
+
+            self._soda = Socrata(
+                os.getenv("SO_WEB"),
+                os.getenv("SO_TOKEN"),
+                username=os.getenv("SO_KEY"),
+                password=os.getenv("SO_SECRET"),
+                timeout=500,
+            )
+        return self._soda
+
+
+def extract(args, clients):
+    import microstrategy_to_s3
+
+    # All configured reports are extracted unless one is provided
+    if args.report_name:
+        report_names = [args.report_name]
+    else:
+        report_names = list(microstrategy_to_s3.REPORTS)
+    for report_name in report_names:
+        report_args = argparse.Namespace(
+            report_name=report_name, window_days=args.window_days
+        )
+        microstrategy_to_s3.main(report_args, conn=clients.mstro, s3=clients.s3)
+
+
+def load(args, clients):
+    import bond_data
+
+    bond_data.main(client=clients.postgrest, s3_client=clients.s3.meta.client)
+
+
+def calculate(args, clients):
+    import bond_calculations
+
+    bond_calculations.main(client=clients.postgrest, soda=clients.soda)
+
+
+def reconcile(args, clients):
+    import reconcile
+
+    reconcile.main(
+        client=clients.postgrest,
+        s3_client=clients.s3.meta.client,
+        soda=clients.soda,
+        fix=args.fix,
+    )
+
+
+def work(args, clients):
+    import worker
+
+    worker.main(args, clients)
+
+
+def run_all(args, clients):
+    extract(args, clients)
+    load(args, clients)
+    calculate(args, clients)
+
+
+def import_stage(stage):
+    """
+    Imports the modules a subcommand needs and builds its API clients, used to
+    measure its startup time
+    """
+    for module in STAGES[stage]:
+        # __import__ goes through the same path as an import statement so
+        # -X importtime reports it (importlib.import_module does not)
+        __import__(module)
+
+    clients = Clients()
+    for name in STAGE_CLIENTS[stage]:
+        # Connecting to Microstrategy needs the network, mstrio is already imported
+        # by microstrategy_to_s3
+        if name != "mstro":
+            getattr(clients, name)
+
+
+def import_time(stage):
+    """
+    Measures the startup time of a subcommand (imports and API clients) in a new
+    interpreter
+
+    Parameters
+    ----------
+    stage: name of the subcommand
+
+    Returns: tuple of (total import time in ms reported by -X importtime,
+        wall clock time of the whole process in ms, slowest top-level imports)
+    -------
+    """
+    start = time.perf_counter()
+    res = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            f"import bond_reporting; bond_reporting.import_stage({stage!r})",
+        ],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        # Socrata requires a domain to build its client, nothing is requested
+        env={**os.environ, "SO_WEB": os.getenv("SO_WEB") or "bench.invalid"},
+    )
+    wall = (time.perf_counter() - start) * 1000
+    if res.returncode != 0:
+        raise RuntimeError(res.stderr.splitlines()[-1])
+
+    # Only top-level imports are summed, their cumulative time includes their children
+    top_level = []
+    for line in res.stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match and not match.group(2):
+            top_level.append((int(match.group(1)) / 1000, match.group(3)))
+    total = sum(ms for ms, _ in top_level)
+    return total, wall, sorted(top_level, reverse=True)[:5]
+
+
+def bench(args, clients):
+    print(f"{'subcommand':<12}{'imports (ms)':>14}{'process (ms)':>14}  slowest imports")
+    for stage in args.stages or STAGES:
+        total, wall, slowest = import_time(stage)
+        slowest = ", ".join(f"{name} {ms:.0f}" for ms, name in slowest)
+        print(f"{stage:<12}{total:>14.1f}{wall:>14.1f}  {slowest}")
+
+
+def add_worker_arguments(parser):
+    # The defaults are read here so the worker module is only imported to run it
+    parser.add_argument(
+        "-i",
+        "--interval",
+        type=int,
+        help="int: Seconds between refreshes.",
+        default=int(os.getenv("WORKER_INTERVAL", 3 * 60 * 60)),
+    )
+    parser.add_argument(
+        "-w",
+        "--window-days",
+        type=int,
+        help="int: Extract the last N days of the Microstrategy reports every refresh. "
+        "Omit to only load and calculate.",
+        default=None,
+    )
+    parser.add_argument(
+        "-m",
+        "--memory-mb",
+        type=float,
+        help="float: Memory cap of the tables and ledgers kept between refreshes.",
+        default=float(os.getenv("WORKER_MEMORY_MB", 1024)),
+    )
+    parser.add_argument(
+        "-p",
+        "--port",
+        type=int,
+        help="int: Local port of the health and metrics endpoint.",
+        default=int(os.getenv("WORKER_PORT", 8080)),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    extract_parser = subparsers.add_parser("extract", help="Microstrategy reports -> S3")
+    all_parser = subparsers.add_parser("all", help="Runs extract, load, and calculate")
+    for p in (extract_parser, all_parser):
+        p.add_argument(
+            "-r",
+            "--report-name",
+            type=str,
+            help="str: Name of the Microstrategy Report to download, defaults to all reports in the config.",
+            default=None,
+        )
+        p.add_argument(
+            "-w",
+            "--window-days",
+            type=int,
+            help="int: Only download the last N days of the reports, see microstrategy_to_s3.py.",
+            default=None,
+        )
+    subparsers.add_parser("load", help="CSVs -> postgres")
+    subparsers.add_parser("calculate", help="postgres -> Socrata")
+    reconcile_parser = subparsers.add_parser(
+        "reconcile", help="Checks that S3, postgres, and Socrata match"
+    )
+    reconcile_parser.add_argument(
+        "--fix", action="store_true", help="Re-send the partitions that do not match."
+    )
+    worker_parser = subparsers.add_parser(
+        "worker", help="Keeps running and refreshes the dashboard on a schedule"
+    )
+    add_worker_arguments(worker_parser)
+    bench_parser = subparsers.add_parser(
+        "bench", help="Measures the startup time of each subcommand"
+    )
+    bench_parser.add_argument(
+        "stages", nargs="*", help=f"subcommands to measure, any of {list(STAGES)}"
+    )
+
+    args = parser.parse_args()
+    if args.command == "bench":
+        for stage in args.stages:
+            if stage not in STAGES:
+                parser.error(f"Unknown subcommand to measure: {stage}")
+    # Only patches the clients if OFFLINE_MODE is set
+    import offline
+
+    offline.install()
+
+    commands = {
+        "extract": extract,
+        "load": load,
+        "calculate": calculate,
+        "all": run_all,
+        "reconcile": reconcile,
+        "worker": work,
+        "bench": bench,
+    }
+    commands[args.command](args, Clients())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,9 @@
+-- The two raw expense tables are loaded from Microstrategy on every run, they are
+-- range partitioned by fiscal year (Oct 1 - Sep 30) on "date". Each has a
+-- _staging twin with the same layout. bond_data.py sends the new load to
+-- api.load_raw() which inserts it into the staging table, swaps the two tables by
+-- renaming them, and truncates the old load in one transaction. No rows are
+-- deleted one by one.
 CREATE TABLE api.expenses_obligated_2020_bond_raw (
   "fund" text,
   "department" int,
@@ -8,7 +14,11 @@ CREATE TABLE api.expenses_obligated_2020_bond_raw (
   "obligated" numeric,
   "expenses" numeric,
   "updated_at" timestamp
-);
+) PARTITION BY RANGE ("date");
+
+CREATE TABLE api.expenses_obligated_2020_bond_raw_staging (
+  LIKE api.expenses_obligated_2020_bond_raw
+) PARTITION BY RANGE ("date");
 
 CREATE TABLE api.expenses_obligated_all_bonds_raw (
   "fund_code" text,
@@ -23,7 +33,284 @@ CREATE TABLE api.expenses_obligated_all_bonds_raw (
   "obligated" numeric,
   "expenses" numeric,
   "updated_at" timestamp
-);
+) PARTITION BY RANGE ("date");
+
+CREATE TABLE api.expenses_obligated_all_bonds_raw_staging (
+  LIKE api.expenses_obligated_all_bonds_raw
+) PARTITION BY RANGE ("date");
+
+-- One partition per fiscal year named <table>_fyYYYY, plus a default partition
+-- for anything outside of this range
+DO $$
+DECLARE
+  tbl text;
+  fy int;
+BEGIN
+  FOREACH tbl IN ARRAY ARRAY[
+    'expenses_obligated_2020_bond_raw',
+    'expenses_obligated_2020_bond_raw_staging',
+    'expenses_obligated_all_bonds_raw',
+    'expenses_obligated_all_bonds_raw_staging'
+  ] LOOP
+    FOR fy IN 2013..2035 LOOP
+      EXECUTE format(
+        'CREATE TABLE api.%I PARTITION OF api.%I FOR VALUES FROM (%L) TO (%L)',
+        tbl || '_fy' || fy, tbl, make_date(fy - 1, 10, 1), make_date(fy, 10, 1)
+      );
+    END LOOP;
+    EXECUTE format('CREATE TABLE api.%I PARTITION OF api.%I DEFAULT', tbl || '_default', tbl);
+  END LOOP;
+END $$;
+
+-- Indexes are created on every partition
+CREATE INDEX ON api.expenses_obligated_2020_bond_raw ("updated_at");
+CREATE INDEX ON api.expenses_obligated_2020_bond_raw ("department", "fund", "division", "group", "fiscal_year", "date");
+CREATE INDEX ON api.expenses_obligated_2020_bond_raw_staging ("updated_at");
+CREATE INDEX ON api.expenses_obligated_2020_bond_raw_staging ("department", "fund", "division", "group", "fiscal_year", "date");
+CREATE INDEX ON api.expenses_obligated_all_bonds_raw ("updated_at");
+CREATE INDEX ON api.expenses_obligated_all_bonds_raw ("department", "fund_code", "division_code", "group_code", "date");
+CREATE INDEX ON api.expenses_obligated_all_bonds_raw_staging ("updated_at");
+CREATE INDEX ON api.expenses_obligated_all_bonds_raw_staging ("department", "fund_code", "division_code", "group_code", "date");
+
+-- Role of the JWT in POSTGREST_TOKEN, the functions below run as their owner so only
+-- this role may call them. The PostgREST authenticator role must be granted it.
+DO $$
+BEGIN
+  IF NOT EXISTS (SELECT FROM pg_roles WHERE rolname = 'bond_loader') THEN
+    CREATE ROLE bond_loader NOLOGIN;
+  END IF;
+END $$;
+GRANT USAGE ON SCHEMA api TO bond_loader;
+
+-- Makes the staging table the live table (and its partitions) by renaming them, the
+-- previous load becomes the staging table and is truncated.
+CREATE OR REPLACE FUNCTION api.swap_raw_load(target text) RETURNS void
+LANGUAGE plpgsql SECURITY DEFINER SET search_path = api AS $$
+DECLARE
+  staging text := target || '_staging';
+  swap text := target || '_swap';
+  part record;
+BEGIN
+  IF target NOT IN ('expenses_obligated_2020_bond_raw', 'expenses_obligated_all_bonds_raw') THEN
+    RAISE EXCEPTION 'Unknown raw table %', target;
+  END IF;
+
+  -- Partitions: live -> swap, staging -> live, swap -> staging
+  FOR part IN
+    SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = format('api.%I', target)::regclass
+  LOOP
+    EXECUTE format('ALTER TABLE api.%I RENAME TO %I', part.relname,
+      swap || substr(part.relname, length(target) + 1));
+  END LOOP;
+  FOR part IN
+    SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = format('api.%I', staging)::regclass
+  LOOP
+    EXECUTE format('ALTER TABLE api.%I RENAME TO %I', part.relname,
+      target || substr(part.relname, length(staging) + 1));
+  END LOOP;
+  FOR part IN
+    SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = format('api.%I', target)::regclass
+  LOOP
+    EXECUTE format('ALTER TABLE api.%I RENAME TO %I', part.relname,
+      staging || substr(part.relname, length(swap) + 1));
+  END LOOP;
+
+  -- Parent tables
+  EXECUTE format('ALTER TABLE api.%I RENAME TO %I', target, swap);
+  EXECUTE format('ALTER TABLE api.%I RENAME TO %I', staging, target);
+  EXECUTE format('ALTER TABLE api.%I RENAME TO %I', swap, staging);
+
+  -- Drop the old load, truncate only swaps out the files
+  EXECUTE format('TRUNCATE api.%I', staging);
+  NOTIFY pgrst, 'reload schema';
+END $$;
+
+-- Only called by api.load_raw, which holds the load lock
+REVOKE EXECUTE ON FUNCTION api.swap_raw_load(text) FROM PUBLIC;
+
+-- Replaces a raw table with rows (a JSON array of the table's rows) in a single
+-- transaction: empties the staging table, inserts the rows into it, then swaps it
+-- with the live table. Loads of the same table take an advisory lock so a second
+-- loader (ex: worker.py next to the scheduled run) waits for the first to commit
+-- and can never swap in a partial load. The last load to commit wins.
+CREATE OR REPLACE FUNCTION api.load_raw(target text, rows json) RETURNS void
+LANGUAGE plpgsql SECURITY DEFINER SET search_path = api AS $$
+DECLARE
+  staging text := target || '_staging';
+BEGIN
+  IF target NOT IN ('expenses_obligated_2020_bond_raw', 'expenses_obligated_all_bonds_raw') THEN
+    RAISE EXCEPTION 'Unknown raw table %', target;
+  END IF;
+
+  PERFORM pg_advisory_xact_lock(hashtext('api.load_raw'), hashtext(target));
+  EXECUTE format('TRUNCATE api.%I', staging);
+  EXECUTE format(
+    'INSERT INTO api.%1$I SELECT * FROM json_populate_recordset(NULL::api.%1$I, $1)',
+    staging
+  ) USING rows;
+  PERFORM api.swap_raw_load(target);
+END $$;
+
+REVOKE EXECUTE ON FUNCTION api.load_raw(text, json) FROM PUBLIC;
+GRANT EXECUTE ON FUNCTION api.load_raw(text, json) TO bond_loader;
+
+-- Fingerprint of a raw expense table for reconcile.py, one row per fiscal year and
+-- AIMS DeptFundProgAct with the row count, sums, and an order independent hash of the
+-- rows (sum of the first 60 bits of the md5 of each row, mod 2^60)
+CREATE OR REPLACE FUNCTION api.raw_fingerprint(target text)
+RETURNS TABLE (
+  "fiscal_year" int,
+  "department" int,
+  "fund" text,
+  "division" text,
+  "group" text,
+  "row_count" bigint,
+  "expenses" numeric,
+  "obligated" numeric,
+  "row_hash" bigint
+)
+LANGUAGE plpgsql STABLE SECURITY DEFINER SET search_path = api AS $$
+DECLARE
+  cols text[];
+BEGIN
+  IF target = 'expenses_obligated_2020_bond_raw' THEN
+    cols := ARRAY['fund', 'division', 'group'];
+  ELSIF target = 'expenses_obligated_all_bonds_raw' THEN
+    cols := ARRAY['fund_code', 'division_code', 'group_code'];
+  ELSE
+    RAISE EXCEPTION 'Unknown raw table %', target;
+  END IF;
+
+  RETURN QUERY EXECUTE format($q$
+    SELECT
+      extract(year FROM t."date" + interval '3 months')::int,
+      t."department",
+      t.%1$I,
+      t.%2$I,
+      t.%3$I,
+      count(*),
+      sum(t."expenses"),
+      sum(t."obligated"),
+      (sum(('x' || substr(md5(concat_ws('|',
+        t."department", t.%1$I, t.%2$I, t.%3$I, to_char(t."date", 'YYYY-MM-DD'),
+        round(t."expenses" * 100)::bigint, round(t."obligated" * 100)::bigint
+      )), 1, 15))::bit(60)::bigint) %% 1152921504606846976)::bigint
+    FROM api.%4$I t
+    GROUP BY 1, 2, 3, 4, 5
+  $q$, cols[1], cols[2], cols[3], target);
+END $$;
+
+REVOKE EXECUTE ON FUNCTION api.raw_fingerprint(text) FROM PUBLIC;
+GRANT EXECUTE ON FUNCTION api.raw_fingerprint(text) TO bond_loader;
+
+-- Replaces some partitions of a raw table with rows, for reconcile.py --fix.
+-- partitions is a JSON array of the keys api.raw_fingerprint returns (fiscal year
+-- and AIMS DeptFundProgAct). It takes the load lock of api.load_raw and deletes and
+-- inserts in one transaction, so a load can not swap the table in between.
+CREATE OR REPLACE FUNCTION api.resend_raw(target text, partitions json, rows json)
+RETURNS void
+LANGUAGE plpgsql SECURITY DEFINER SET search_path = api AS $$
+DECLARE
+  cols text[];
+BEGIN
+  IF target = 'expenses_obligated_2020_bond_raw' THEN
+    cols := ARRAY['fund', 'division', 'group'];
+  ELSIF target = 'expenses_obligated_all_bonds_raw' THEN
+    cols := ARRAY['fund_code', 'division_code', 'group_code'];
+  ELSE
+    RAISE EXCEPTION 'Unknown raw table %', target;
+  END IF;
+
+  PERFORM pg_advisory_xact_lock(hashtext('api.load_raw'), hashtext(target));
+  EXECUTE format($q$
+    DELETE FROM api.%4$I t
+    USING json_to_recordset($1) AS p(
+      "fiscal_year" int, "department" int, "fund" text, "division" text, "group" text
+    )
+    WHERE t."date" >= make_date(p."fiscal_year" - 1, 10, 1)
+      AND t."date" < make_date(p."fiscal_year", 10, 1)
+      AND t."department" IS NOT DISTINCT FROM p."department"
+      AND t.%1$I IS NOT DISTINCT FROM p."fund"
+      AND t.%2$I IS NOT DISTINCT FROM p."division"
+      AND t.%3$I IS NOT DISTINCT FROM p."group"
+  $q$, cols[1], cols[2], cols[3], target) USING partitions;
+  EXECUTE format(
+    'INSERT INTO api.%1$I SELECT * FROM json_populate_recordset(NULL::api.%1$I, $1)',
+    target
+  ) USING rows;
+END $$;
+
+REVOKE EXECUTE ON FUNCTION api.resend_raw(text, json, json) FROM PUBLIC;
+GRANT EXECUTE ON FUNCTION api.resend_raw(text, json, json) TO bond_loader;
+
+-- Expected fingerprint of the datasets bond_calculations.py calculates from a raw
+-- table, for reconcile.py: one row per fiscal year (null for all bonds) and AIMS
+-- DeptFundProgAct with the row count and sums. The calculations add a zero row for
+-- every date (and fiscal year for the 2020 bond) a group has no row on, those
+-- only add to the count. All bonds only keeps the first row of a group and date, in
+-- the order bond_calculations.get_data reads them (ROW_ORDER).
+CREATE OR REPLACE FUNCTION api.raw_totals(target text)
+RETURNS TABLE (
+  "fiscal_year" int,
+  "aims_dept_prog_act" text,
+  "row_count" bigint,
+  "expenses" numeric,
+  "obligated" numeric
+)
+LANGUAGE plpgsql STABLE SECURITY DEFINER SET search_path = api AS $$
+#variable_conflict use_column
+BEGIN
+  IF target = 'expenses_obligated_2020_bond_raw' THEN
+    RETURN QUERY
+    WITH raw AS (
+      SELECT t."fiscal_year" AS fy,
+        t."department"::text || t."fund" || t."division" || t."group" AS aims,
+        t."date", t."expenses", t."obligated"
+      FROM api.expenses_obligated_2020_bond_raw t
+    ), totals AS (
+      SELECT r.fy, r.aims, count(*) AS n, count(DISTINCT r."date") AS n_dates,
+        sum(r."expenses") AS expenses, sum(r."obligated") AS obligated
+      FROM raw r
+      GROUP BY r.fy, r.aims
+    )
+    SELECT f.fy, g.aims,
+      coalesce(t.n, 0) + d.n_dates - coalesce(t.n_dates, 0),
+      coalesce(t.expenses, 0),
+      coalesce(t.obligated, 0)
+    FROM (SELECT DISTINCT r.fy FROM raw r) f
+    CROSS JOIN (SELECT DISTINCT r.aims FROM raw r) g
+    CROSS JOIN (SELECT count(DISTINCT r."date") AS n_dates FROM raw r) d
+    LEFT JOIN totals t
+      ON t.fy IS NOT DISTINCT FROM f.fy AND t.aims IS NOT DISTINCT FROM g.aims;
+  ELSIF target = 'expenses_obligated_all_bonds_raw' THEN
+    RETURN QUERY
+    WITH raw AS (
+      SELECT DISTINCT ON (s.aims, s."date") s.aims, s."date", s."expenses", s."obligated"
+      FROM (
+        SELECT t."department"::text || t."fund_code" || t."division_code" || t."group_code" AS aims,
+          t.*
+        FROM api.expenses_obligated_all_bonds_raw t
+      ) s
+      ORDER BY s.aims, s."date", s."updated_at", s."expenses", s."obligated",
+        s."fund_long_name", s."division_long_name", s."department_long_name",
+        s."group_long_name"
+    )
+    SELECT NULL::int, r.aims, d.n_dates,
+      coalesce(sum(r."expenses"), 0),
+      coalesce(sum(r."obligated"), 0)
+    FROM raw r
+    CROSS JOIN (SELECT count(DISTINCT r2."date") AS n_dates FROM raw r2) d
+    GROUP BY r.aims, d.n_dates;
+  ELSE
+    RAISE EXCEPTION 'Unknown raw table %', target;
+  END IF;
+END $$;
+
+REVOKE EXECUTE ON FUNCTION api.raw_totals(text) FROM PUBLIC;
+GRANT EXECUTE ON FUNCTION api.raw_totals(text) TO bond_loader;
 
 CREATE TABLE api.bond_2020_baseline_spend (
   "dashboard_deptfundprogact" text,
@@ -2,7 +2,34 @@
 Configuration for the data sources of CSVs
 """
 
-from pandera import Column, DataFrameSchema, Check
+
+def build_schema(columns):
+    """
+    Builds the pandera DataFrameSchema for a table's "schema" config.
+
+    pandera is only imported here so that importing this config stays cheap for the
+    scripts that never validate a CSV.
+
+    Parameters
+    ----------
+    columns: dict of column name: dtype, or column name: (dtype, {check name: value})
+        where the check name is a pandera Check, ex: {"greater_than": 2000}
+
+    Returns: pandera DataFrameSchema object for the table
+    -------
+    """
+    from pandera import Column, DataFrameSchema, Check
+
+    schema = {}
+    for name, dtype in columns.items():
+        checks = {}
+        if isinstance(dtype, tuple):
+            dtype, checks = dtype
+        schema[name] = Column(
+            dtype,
+            checks=[getattr(Check, check)(value) for check, value in checks.items()],
+        )
+    return DataFrameSchema(schema, strict=True)
 
 # Microstrategy file names in S3
 BOND_2020_EXP = "2020 Bond Expenses Obligated.csv"
@@ -37,6 +64,9 @@ CSVS = [
         "table": "expenses_obligated_2020_bond_raw",  # Name of the table in the DB
         "date_field": True,  # True if this CSV has a "date" field
         "boto3": True,  # True if we should use boto3 to read this file from S3
+        "swap": True,  # True if the table is loaded through its _staging table (see bond_tables.sql)
+        # Columns that make up the AIMS DeptFundProgAct, used by reconcile.py (expense tables only)
+        "group_key": ["department", "fund", "division", "group"],
         "field_maps": {  # Mapping between CSV column names and those expected by the table
             "Fund": "fund",
             "Department": "department",
@@ -47,25 +77,24 @@ CSVS = [
             "Obligated": "obligated",
             "Expenses": "expenses",
         },
-        "schema": DataFrameSchema(  # Schema expected by the table
-            {
-                "fund": Column(str),
-                "department": Column(int),
-                "date": Column(str),
-                "group": Column(str),
-                "fiscal_year": Column(int, Check.greater_than(2000)),
-                "division": Column(str),
-                "obligated": Column(float),
-                "expenses": Column(float),
-            },
-            strict=True,
-        ),
+        "schema": {  # Schema expected by the table, see build_schema
+            "fund": str,
+            "department": int,
+            "date": "datetime64[ns]",
+            "group": str,
+            "fiscal_year": (int, {"greater_than": 2000}),
+            "division": str,
+            "obligated": float,
+            "expenses": float,
+        },
     },
     {
         "url": ALL_BONDS_EXP,
         "table": "expenses_obligated_all_bonds_raw",
         "date_field": True,
         "boto3": True,
+        "swap": True,
+        "group_key": ["department", "fund_code", "division_code", "group_code"],
         "field_maps": {
             "Fund@Code": "fund_code",
             "Fund@Long Name": "fund_long_name",
@@ -79,121 +108,109 @@ CSVS = [
             "Obligated": "obligated",
             "Expenses": "expenses",
         },
-        "schema": DataFrameSchema(
-            {
-                "fund_code": Column(str),
-                "fund_long_name": Column(str),
-                "date": Column(str),
-                "division_code": Column(str),
-                "division_long_name": Column(str),
-                "department": Column(int),
-                "department_long_name": Column(str),
-                "group_code": Column(str),
-                "group_long_name": Column(str),
-                "obligated": Column(float),
-                "expenses": Column(float),
-            },
-            strict=True,
-        ),
+        "schema": {
+            "fund_code": str,
+            "fund_long_name": str,
+            "date": "datetime64[ns]",
+            "division_code": str,
+            "division_long_name": str,
+            "department": int,
+            "department_long_name": str,
+            "group_code": str,
+            "group_long_name": str,
+            "obligated": float,
+            "expenses": float,
+        },
     },
     {
         "url": AIMS_DASHBOARD,
         "table": "bond_2020_aims_to_dashboard",
         "date_field": False,
         "boto3": False,
+        "swap": False,
         "field_maps": {
             "AIMS Dept Prog Act": "aims_dept_prog_act",
             "Dashboard DeptFundProgAct": "dashboard_deptfundprogact",
         },
-        "schema": DataFrameSchema(
-            {
-                "aims_dept_prog_act": Column(str),
-                "dashboard_deptfundprogact": Column(str),
-            },
-            strict=True,
-        ),
+        "schema": {
+            "aims_dept_prog_act": str,
+            "dashboard_deptfundprogact": str,
+        },
     },
     {
         "url": BASELINE_SPEND,
         "table": "bond_2020_baseline_spend",
         "date_field": True,
         "boto3": False,
+        "swap": False,
         "field_maps": {
             "Dashboard DeptFundProgAct": "dashboard_deptfundprogact",
             "Date": "date",
             "Amount": "amount",
         },
-        "schema": DataFrameSchema(
-            {
-                "dashboard_deptfundprogact": Column(str),
-                "date": Column(str),
-                "amount": Column(float),
-            },
-            strict=True,
-        ),
+        "schema": {
+            "dashboard_deptfundprogact": str,
+            "date": "datetime64[ns]",
+            "amount": float,
+        },
     },
     {
         "url": CY_SPEND_PLAN,
         "table": "bond_2020_current_fy_spend_plan",
         "date_field": True,
         "boto3": False,
+        "swap": False,
         "field_maps": {
             "Dashboard DeptFundProgAct": "dashboard_deptfundprogact",
             "Date": "date",
             "Amount": "amount",
         },
-        "schema": DataFrameSchema(
-            {
-                "dashboard_deptfundprogact": Column(str),
-                "date": Column(str),
-                "amount": Column(float),
-            },
-            strict=True,
-        ),
+        "schema": {
+            "dashboard_deptfundprogact": str,
+            "date": "datetime64[ns]",
+            "amount": float,
+        },
     },
     {
         "url": PY_SPEND_PLAN,
         "table": "bond_2020_previous_fy_spend_plan",
         "date_field": True,
         "boto3": False,
+        "swap": False,
         "field_maps": {
             "Dashboard DeptFundProgAct": "dashboard_deptfundprogact",
             "Date": "date",
             "Amount": "amount",
         },
-        "schema": DataFrameSchema(
-            {
-                "dashboard_deptfundprogact": Column(str),
-                "date": Column(str),
-                "amount": Column(float),
-            },
-            strict=True,
-        ),
+        "schema": {
+            "dashboard_deptfundprogact": str,
+            "date": "datetime64[ns]",
+            "amount": float,
+        },
     },
     {
         "url": APPRO_DATA,
         "table": "all_bonds_appropriations",
         "date_field": True,
         "boto3": False,
+        "swap": False,
         "field_maps": {
             "Dashboard FundDeptProgAct": "dashboard_deptfundprogact",
             "Date": "date",
             "Appropriation": "amount",
         },
-        "schema": DataFrameSchema(
-            {
-                "dashboard_deptfundprogact": Column(str),
-                "date": Column(str),
-                "amount": Column(int),
-            },
-            strict=True,
-        ),
+        "schema": {
+            "dashboard_deptfundprogact": str,
+            "date": "datetime64[ns]",
+            "amount": int,
+        },
     },
     {
         "url": DEPTFUNDPROGACT,
         "table": "all_bonds_program_names",
         "date_field": False,
         "boto3": False,
+        "swap": False,
         "field_maps": {
             "Dashboard FundDeptProgAct": "dashboard_deptfundprogact",
             "Dashboard Dept Name": "department_name",
@@ -203,79 +220,71 @@ CSVS = [
             "Program Sort": "program_sort",
             "Sub Program Sort": "sub_program_sort",
         },
-        "schema": DataFrameSchema(
-            {
-                "dashboard_deptfundprogact": Column(str),
-                "department_name": Column(str),
-                "bond_year": Column(int),
-                "program_name": Column(str),
-                "sub_program_name": Column(str),
-                "program_sort": Column(int),
-                "sub_program_sort": Column(int),
-            },
-            strict=True,
-        ),
+        "schema": {
+            "dashboard_deptfundprogact": str,
+            "department_name": str,
+            "bond_year": int,
+            "program_name": str,
+            "sub_program_name": str,
+            "program_sort": int,
+            "sub_program_sort": int,
+        },
     },
     {
         "url": AIMS_ALL_BONDS_DASHBOARD,
         "table": "all_bonds_aims_to_dashboard",
         "date_field": False,
         "boto3": False,
+        "swap": False,
         "field_maps": {
             "AIMS Dept Prog Act": "aims_dept_prog_act",
             "Dashboard FundDeptProgAct": "dashboard_deptfundprogact",
         },
-        "schema": DataFrameSchema(
-            {
-                "aims_dept_prog_act": Column(str),
-                "dashboard_deptfundprogact": Column(str),
-            },
-            strict=True,
-        ),
+        "schema": {
+            "aims_dept_prog_act": str,
+            "dashboard_deptfundprogact": str,
+        },
     },
     {
         "url": SPEND_PLAN_ALL,
         "table": "all_bonds_spend_plan",
         "date_field": False,
         "boto3": False,
+        "swap": False,
         "field_maps": {
             "Dashboard FundDeptProgAct": "dashboard_deptfundprogact",
             "Fiscal Year": "fiscal_year",
             "SpndPln-Bdgt":"amount",
         },
-        "schema": DataFrameSchema(
-            {
-                "dashboard_deptfundprogact": Column(str),
-                "fiscal_year": Column(int),
-                "amount": Column(float),
-            },
-            strict=True,
-        ),
+        "schema": {
+            "dashboard_deptfundprogact": str,
+            "fiscal_year": int,
+            "amount": float,
+        },
     },
     {
         "url": BASELINE_SPEND_ALL,
         "table": "all_bonds_baseline_spend",
         "date_field": True,
         "boto3": False,
+        "swap": False,
         "field_maps": {
             "Dashboard FundDeptProgAct": "dashboard_deptfundprogact",
             "Date": "date",
             "Amount": "amount",
         },
-        "schema": DataFrameSchema(
-            {
-                "dashboard_deptfundprogact": Column(str),
-                "date": Column(str),
-                "amount": Column(int),
-            },
-            strict=True,
-        ),
+        "schema": {
+            "dashboard_deptfundprogact": str,
+            "date": "datetime64[ns]",
+            "amount": int,
+        },
     },
     {
         "url": BOND_PROG_NAMES,
         "table": "bond_2020_program_names",
         "date_field": False,
         "boto3": False,
+        "swap": False,
         "field_maps": {
             "Dashboard DeptFundProgAct": "dashboard_deptfundprogact",
             "Dashboard Dept Name": "department_name",
@@ -286,18 +295,15 @@ CSVS = [
             "Program Sort": "program_sort",
             "Sub Program Sort": "sub_program_sort",
         },
-        "schema": DataFrameSchema(
-            {
-                "dashboard_deptfundprogact": Column(str),
-                "department_name": Column(str),
-                "bond_year": Column(int),
-                "program_name": Column(str),
-                "sub_program_name": Column(str),
-                "funding_amount": Column(int),
-                "program_sort": Column(int),
-                "sub_program_sort": Column(int),
-            },
-            strict=True,
-        ),
+        "schema": {
+            "dashboard_deptfundprogact": str,
+            "department_name": str,
+            "bond_year": int,
+            "program_name": str,
+            "sub_program_name": str,
+            "funding_amount": int,
+            "program_sort": int,
+            "sub_program_sort": int,
+        },
     },
 ]
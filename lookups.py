@@ -0,0 +1,81 @@
+"""
+Lookup indexes for joining the dimension tables (crosswalks, program names,
+appropriations) onto fact rows
+"""
+
+import pandas as pd
+from pandas.api.extensions import take
+
+
+def first_rows(df, key):
+    """
+    Returns the rows of a dimension table with a key, only the first row of a
+    duplicated key is kept so joining on it does not repeat the fact rows. Every
+    compute backend joins the dimension tables through this.
+    """
+    duplicated = df[key].duplicated()
+    if duplicated.any():
+        keys = df.loc[duplicated, key].unique().tolist()
+        print(f"Duplicate {key} in the lookup table, the first row is used: {keys}")
+    return df[~duplicated & df[key].notna()]
+
+
+def unmapped_keys(keys, table_keys):
+    """
+    Returns: list of the keys that are not in table_keys, see Lookup.unmapped for
+        the keys already looked up
+    """
+    keys = pd.Series(keys)
+    return keys[~keys.isin(table_keys) & keys.notna()].unique().tolist()
+
+
+def report_unmapped(key, unmapped):
+    """
+    Prints the keys of the fact rows that are not in a dimension table, those rows are
+    left out of the join. Every compute backend reports them through this.
+    """
+    if unmapped:
+        print(f"{key} not in the lookup table, its rows are left out: {unmapped}")
+    return unmapped
+
+
+class Lookup:
+    """
+    Hashed index of a dimension table on its key column.
+
+    The keys are hashed once when the lookup is built. Fact rows are then joined by
+    looking up the integer position of their key and taking the dimension's values
+    at those positions, instead of merging on the string key every time. Keys that
+    are not in the table come back as position -1 from the same lookup, so unmapped
+    keys are found without scanning the facts again.
+
+    Parameters
+    ----------
+    df: Pandas dataframe of the dimension table
+    key: column the fact rows are joined on, see first_rows
+    """
+
+    def __init__(self, df, key):
+        self.key = key
+        self.table = first_rows(df, key).reset_index(drop=True)
+        self.index = pd.Index(self.table[key])
+
+    def positions(self, keys):
+        """
+        Returns: numpy array of the row of each key in the table, -1 if it is not in it
+        """
+        return self.index.get_indexer(keys)
+
+    def take(self, positions, column):
+        """
+        Returns: numpy array of the column's values at positions, missing where the
+            position is -1 (ints become floats like a left merge)
+        """
+        return take(self.table[column].to_numpy(), positions, allow_fill=True)
+
+    def unmapped(self, keys, positions):
+        """
+        Returns: list of the keys that are not in the table, see positions
+        """
+        keys = pd.Series(keys)
+        return keys[(positions == -1) & keys.notna().to_numpy()].unique().tolist()
@@ -6,9 +6,13 @@ import argparse
 
 # Related third party imports
 import boto3
+import pandas as pd
+from pandas.api.types import is_bool_dtype, is_numeric_dtype
 from mstrio.connection import Connection
 from mstrio.project_objects.report import Report
 
+import offline
+
 BASE_URL = os.getenv("BASE_URL")
 MSTRO_USERNAME = os.getenv("MSTRO_USERNAME")
 MSTRO_PASSWORD = os.getenv("MSTRO_PASSWORD")
@@ -22,6 +26,11 @@ REPORTS = {
     "2020 Bond Expenses Obligated": "D6BC5BD13143FF3129F3318F589EBD51",
     "All bonds Expenses Obligated": "077C066E6C4BF56B081F96A3E405D83C",
 }
+# Name of the date attribute in the reports and the format of its values.
+# Used to only extract a trailing window of dates with the --window-days argument.
+DATE_ATTRIBUTE = "Date"
+DATE_FORMAT = "%m/%d/%Y"
+
 # To find report ID, go to the report in Microstrategy then:
 ## Go to Tools > Report Details Page or Document Details Page.
 ## Click Show Advanced Details button at the bottom
@@ -35,6 +44,9 @@ REPORTS = {
 
 # Returns a connection object for interacting with the microstrategy API
 def connect_to_mstro():
+    if offline.replaying():
+        # Reports are read from the fixtures, see offline.py
+        return None
     conn = Connection(
         base_url=BASE_URL,
         username=MSTRO_USERNAME,
@@ -58,9 +70,65 @@ def connect_to_AWS():
 
 # Downloads a report from microstrategy with a given report_id
 # returns it as a pandas dataframe
-def download_report(report_id, conn):
+# If start_date is provided, only the dates on or after it are requested from microstrategy
+def download_report(report_id, conn, start_date=None):
+    windowed = start_date is not None
+    if offline.replaying():
+        return offline.replay_report(report_id, windowed)
+
     my_report = Report(conn, id=report_id, parallel=False)
-    return my_report.to_dataframe()
+    df = None
+    if windowed:
+        elements = date_elements_since(my_report, start_date)
+        # If there are no elements, there is nothing new in the window
+        if elements:
+            my_report.apply_filters(attr_elements=elements)
+            df = my_report.to_dataframe()
+    else:
+        df = my_report.to_dataframe()
+
+    if offline.recording():
+        offline.record_report(report_id, windowed, df)
+    return df
+
+
+# Returns the IDs of the report's date attribute elements that are on or after start_date
+def date_elements_since(report, start_date):
+    elements = []
+    for attribute in report.attr_elements:
+        if attribute["attribute_name"] != DATE_ATTRIBUTE:
+            continue
+        for element in attribute["elements"]:
+            date = pd.to_datetime(element["formValues"][0], format=DATE_FORMAT)
+            if date >= start_date:
+                elements.append(element["id"])
+    return elements
+
+
+# Returns the previous snapshot of the report stored in S3 as a dataframe
+# or None if the report has not been uploaded before
+def read_snapshot(report_name, s3):
+    file_name = f"{report_name}.csv"
+    try:
+        response = s3.Object(BUCKET, file_name).get()
+    except s3.meta.client.exceptions.NoSuchKey:
+        return None
+    return pd.read_csv(response["Body"], dtype=str)
+
+
+# Replaces the dates on or after start_date in the snapshot with the new window of data
+def merge_window(snapshot, window, start_date):
+    dates = pd.to_datetime(snapshot[DATE_ATTRIBUTE], format=DATE_FORMAT)
+    snapshot = snapshot[dates < start_date]
+    if window is None:
+        return snapshot
+    # The snapshot is read as text, its numeric columns are parsed like the window's
+    # so each column is written to the CSV in one format (not 1234 and 1234.0)
+    snapshot = snapshot.copy()
+    for col in window.columns:
+        if col in snapshot and is_numeric_dtype(window[col]) and not is_bool_dtype(window[col]):
+            snapshot[col] = pd.to_numeric(snapshot[col])
+    return pd.concat([snapshot, window], ignore_index=True)
 
 
 # Takes a pandas dataframe and formats it to be sent as a .csv in an S3 bucket
@@ -73,20 +141,37 @@ def report_to_s3(df, report_name, s3):
     s3.Object(BUCKET, file_name).put(Body=csv_buffer.getvalue())
 
 
-def main(args):
+# conn and s3 can be passed in to reuse them between reports (see bond_reporting.py)
+def main(args, conn=None, s3=None):
     if args.report_name not in REPORTS:
-        raise "Report name not in configured reports."
+        raise ValueError("Report name not in configured reports.")
 
     report_id = REPORTS[args.report_name]
 
     # 1. Get microstrategy connection
-    conn = connect_to_mstro()
+    if conn is None:
+        conn = connect_to_mstro()
 
     # 2. Connect using boto3 to our S3
-    s3 = connect_to_AWS()
+    if s3 is None:
+        s3 = connect_to_AWS()
 
     # 3. Download report to df
-    df = download_report(report_id, conn)
+    if args.window_days is None:
+        # Full refresh
+        df = download_report(report_id, conn)
+    else:
+        # Incremental, only download the trailing window of dates and merge it
+        # into the previous snapshot in S3
+        start_date = pd.Timestamp.today().normalize() - pd.Timedelta(
+            days=args.window_days
+        )
+        snapshot = read_snapshot(args.report_name, s3)
+        if snapshot is None:
+            df = download_report(report_id, conn)
+        else:
+            window = download_report(report_id, conn, start_date)
+            df = merge_window(snapshot, window, start_date)
 
     # 4. Send file to S3 bucket
     report_to_s3(df, args.report_name, s3)
@@ -102,7 +187,16 @@ if __name__ == "__main__":
         help="str: Name of the Microstrategy Report to download, as defined in the config.",
         required=True,
     )
+    parser.add_argument(
+        "-w",
+        "--window-days",
+        type=int,
+        help="int: Only download the last N days of the report and merge them into the previous copy in S3. "
+        "Omit to do a full refresh of the report.",
+        default=None,
+    )
 
     args = parser.parse_args()
 
+    offline.install()
     main(args)
@@ -0,0 +1,306 @@
+"""
+Record/replay offline mode for the bond reporting ETL.
+
+Set OFFLINE_MODE to run any of the scripts against a local fixture store instead
+of the production services:
+
+- record: the scripts run against the real services as usual and every response
+  (PostgREST, Socrata, S3 objects, Microstrategy reports) is saved to OFFLINE_FIXTURES
+- replay: the scripts run without any network, the saved responses are returned by
+  in-process stand-ins. OFFLINE_LATENCY (ms) is added to every call, so compute and
+  network costs can be measured separately.
+
+HTTP is recorded at the requests transport level so it covers pypgrest, sodapy and
+our streaming uploads. S3 and Microstrategy are replaced by fakes.
+"""
+
+import base64
+import hashlib
+import io
+import json
+import os
+import time
+
+OFFLINE_MODE = os.getenv("OFFLINE_MODE")
+OFFLINE_FIXTURES = os.getenv("OFFLINE_FIXTURES", "fixtures")
+OFFLINE_LATENCY = float(os.getenv("OFFLINE_LATENCY", "0"))
+# Microstrategy is replaced by a fake, its API traffic is not recorded
+BASE_URL = os.getenv("BASE_URL")
+
+MODES = ["record", "replay"]
+
+# Number of times each request, S3 read, or Microstrategy report has been made in
+# this process, the nth request to the same URL (or read of the same object or
+# report) is answered with the nth recorded response
+_calls = {}
+
+
+def recording():
+    return OFFLINE_MODE == "record"
+
+
+def replaying():
+    return OFFLINE_MODE == "replay"
+
+
+def latency():
+    if OFFLINE_LATENCY:
+        time.sleep(OFFLINE_LATENCY / 1000)
+
+
+def fixture_path(*parts):
+    path = os.path.join(OFFLINE_FIXTURES, *parts)
+    if recording():
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def install():
+    """
+    Patches requests and boto3 if OFFLINE_MODE is set, call it before creating any client
+    """
+    if not OFFLINE_MODE:
+        return
+    if OFFLINE_MODE not in MODES:
+        raise ValueError(f"OFFLINE_MODE must be one of {MODES}, got {OFFLINE_MODE}")
+
+    import boto3
+    import boto3.session
+    from requests.adapters import HTTPAdapter
+
+    send = HTTPAdapter.send
+    client = boto3.client
+    resource = boto3.session.Session.resource
+
+    def offline_send(adapter, request, **kwargs):
+        if replaying():
+            return replay_http(request)
+        response = send(adapter, request, **kwargs)
+        if not (BASE_URL and request.url.startswith(BASE_URL)):
+            record_http(request, response)
+        return response
+
+    def offline_client(service_name, *args, **kwargs):
+        if service_name != "s3":
+            return client(service_name, *args, **kwargs)
+        if replaying():
+            return FakeS3Client()
+        return RecordingS3Client(client(service_name, *args, **kwargs))
+
+    def offline_resource(session, service_name, *args, **kwargs):
+        if service_name != "s3":
+            return resource(session, service_name, *args, **kwargs)
+        if replaying():
+            return FakeS3Resource(FakeS3Client())
+        real = resource(session, service_name, *args, **kwargs)
+        return FakeS3Resource(RecordingS3Client(real.meta.client))
+
+    HTTPAdapter.send = offline_send
+    boto3.client = offline_client
+    boto3.session.Session.resource = offline_resource
+
+
+# HTTP
+
+
+def http_key(request):
+    # Only the path and query are used so fixtures can be replayed with other hosts
+    url = request.path_url
+    count = _calls.get((request.method, url), 0)
+    _calls[(request.method, url)] = count + 1
+    digest = hashlib.sha1(f"{request.method} {url}".encode()).hexdigest()[:16]
+    return fixture_path("http", f"{request.method.lower()}_{digest}_{count}.json")
+
+
+def record_http(request, response):
+    with open(http_key(request), "w") as f:
+        json.dump(
+            {
+                "method": request.method,
+                "url": request.path_url,
+                "status_code": response.status_code,
+                "headers": dict(response.headers),
+                "content": base64.b64encode(response.content).decode(),
+            },
+            f,
+        )
+
+
+def replay_http(request):
+    from requests import Response
+    from requests.structures import CaseInsensitiveDict
+
+    # Streamed request bodies are still consumed so serialization is measured
+    if request.body is not None and not isinstance(request.body, (bytes, str)):
+        for _ in request.body:
+            pass
+
+    path = http_key(request)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No recorded response for {request.method} {request.path_url}")
+    with open(path) as f:
+        fixture = json.load(f)
+
+    latency()
+    response = Response()
+    response.status_code = fixture["status_code"]
+    response.headers = CaseInsensitiveDict(fixture["headers"])
+    # The body is already decoded
+    response.headers.pop("Content-Encoding", None)
+    response._content = base64.b64decode(fixture["content"])
+    response.url = request.url
+    response.request = request
+    response.encoding = "utf-8"
+    return response
+
+
+# S3
+
+
+class NoSuchKey(Exception):
+    pass
+
+
+class S3Exceptions:
+    NoSuchKey = NoSuchKey
+
+
+def s3_path(bucket, key, count):
+    return fixture_path("s3", bucket, f"{key}.{count}")
+
+
+def s3_read(bucket, key):
+    """
+    Returns the fixture path of the next read of an object, reads are keyed by order
+    like HTTP requests so an object that changes during a run is replayed as it was
+    """
+    count = _calls.get(("s3", bucket, key), 0)
+    _calls[("s3", bucket, key)] = count + 1
+    return s3_path(bucket, key, count)
+
+
+class FakeS3Client:
+    """
+    Serves S3 objects from the fixtures, objects that are put are only kept in memory
+    """
+
+    exceptions = S3Exceptions
+
+    def __init__(self):
+        self.objects = {}
+
+    def read(self, Bucket, Key, path):
+        if (Bucket, Key) in self.objects:
+            return self.objects[(Bucket, Key)]
+        if not os.path.exists(path):
+            raise NoSuchKey(f"{Bucket}/{Key}")
+        with open(path, "rb") as f:
+            return f.read()
+
+    def get_object(self, Bucket, Key):
+        latency()
+        # The read is counted even when the object was put in memory, the recording
+        # read it back from S3
+        path = s3_read(Bucket, Key)
+        return {"Body": io.BytesIO(self.read(Bucket, Key, path))}
+
+    def head_object(self, Bucket, Key):
+        latency()
+        # Heads are not recorded, they describe the object the next read returns or
+        # the last one read if it is not read again
+        count = _calls.get(("s3", Bucket, Key), 0)
+        path = s3_path(Bucket, Key, count)
+        if count and not os.path.exists(path):
+            path = s3_path(Bucket, Key, count - 1)
+        body = self.read(Bucket, Key, path)
+        return {"ETag": f'"{hashlib.md5(body).hexdigest()}"', "ContentLength": len(body)}
+
+    def put_object(self, Bucket, Key, Body):
+        latency()
+        self.objects[(Bucket, Key)] = Body.encode() if isinstance(Body, str) else Body
+        return {}
+
+
+class RecordingS3Client:
+    """
+    S3 client that saves a copy of every object it reads to the fixtures. Objects
+    that are written are not saved so a replay reads the same objects as the recording.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def get_object(self, Bucket, Key):
+        response = self.client.get_object(Bucket=Bucket, Key=Key)
+        body = response["Body"].read()
+        with open(s3_read(Bucket, Key), "wb") as f:
+            f.write(body)
+        return {**response, "Body": io.BytesIO(body)}
+
+
+class FakeS3Object:
+    def __init__(self, client, bucket, key):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+
+    def get(self):
+        return self.client.get_object(Bucket=self.bucket, Key=self.key)
+
+    def put(self, Body):
+        return self.client.put_object(Bucket=self.bucket, Key=self.key, Body=Body)
+
+
+class FakeS3Meta:
+    def __init__(self, client):
+        self.client = client
+
+
+class FakeS3Resource:
+    """
+    The parts of the boto3 S3 resource used by microstrategy_to_s3.py
+    """
+
+    def __init__(self, client):
+        self.meta = FakeS3Meta(client)
+
+    def Object(self, bucket, key):
+        return FakeS3Object(self.meta.client, bucket, key)
+
+
+# Microstrategy
+
+
+def report_path(report_id, windowed):
+    """
+    Returns the fixture path of the next download of a report, keyed by order like
+    the S3 reads so every cycle of a worker recording is replayed
+    """
+    mode = "window" if windowed else "full"
+    count = _calls.get(("mstro", report_id, mode), 0)
+    _calls[("mstro", report_id, mode)] = count + 1
+    return fixture_path("mstro", f"{report_id}_{mode}_{count}.pkl")
+
+
+def record_report(report_id, windowed, df):
+    import pandas as pd
+
+    # A windowed extraction with nothing new is recorded as None
+    pd.to_pickle(df, report_path(report_id, windowed))
+
+
+def replay_report(report_id, windowed):
+    """
+    Returns the recorded dataframe of a Microstrategy report, it stands in for
+    mstrio's Report.to_dataframe()
+    """
+    import pandas as pd
+
+    latency()
+    path = report_path(report_id, windowed)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No recorded report for {report_id}")
+    return pd.read_pickle(path)
@@ -0,0 +1,307 @@
+"""
+Checks that the bond data matches between S3, postgres, and Socrata.
+
+Instead of downloading the datasets back, each hop is compared with cheap
+fingerprints per partition (fiscal year and AIMS DeptFundProgAct): the row count,
+the sums of expenses and obligated, and for postgres an order independent hash of
+the rows. Postgres and Socrata compute their fingerprints with aggregate queries,
+see api.raw_fingerprint and api.raw_totals in bond_tables.sql. The calculated
+datasets are checked against the totals of their raw table, without running
+the calculations.
+
+With --fix, only the partitions that do not match are re-sent to postgres. The
+Socrata datasets have no row identifier so a mismatched dataset is replaced.
+"""
+
+import argparse
+import hashlib
+from itertools import chain
+import json
+
+import pandas as pd
+from pypgrest import Postgrest
+from sodapy import Socrata
+import boto3
+
+import bond_calculations
+import bond_data
+from config.csv_config import CSVS
+import offline
+from payloads import iter_json
+
+SUMS = ["expenses", "obligated"]
+# Sums are compared to the cent
+TOLERANCE = 0.005
+# Row hashes are the first 60 bits of an md5, their sum is kept mod 2^60
+HASH_MOD = 2**60
+# Partition columns returned by api.raw_fingerprint, the group_key of each raw
+# table is renamed to these
+RAW_KEYS = ["fiscal_year", "department", "fund", "division", "group"]
+
+# Socrata datasets published by bond_calculations.py, their raw table, and their
+# partition columns
+DATASETS = {
+    "vs3t-h2aj": ("expenses_obligated_2020_bond_raw", ["fiscal_year", "aims_dept_prog_act"]),
+    "jdna-s8qn": ("expenses_obligated_2020_bond_raw", ["fiscal_year", "aims_dept_prog_act"]),
+    "rrww-ybw6": ("expenses_obligated_all_bonds_raw", ["aims_dept_prog_act"]),
+}
+# Rows per SoQL request
+SOCRATA_PAGE_SIZE = 50000
+
+
+def city_fiscal_year(dates):
+    # City fiscal years start in October
+    return dates.dt.year + (dates.dt.month > 9)
+
+
+def row_hash(values):
+    # Same as concat_ws('|', ...) then md5 in api.raw_fingerprint, nulls are skipped
+    text = "|".join(str(value) for value in values if value is not None)
+    return int(hashlib.md5(text.encode()).hexdigest()[:15], 16)
+
+
+def nullable(series):
+    return series.astype(object).where(series.notna(), None)
+
+
+def fingerprint_raw(df, group_key):
+    """
+    Fingerprints a raw expense table the same way as api.raw_fingerprint
+
+    Parameters
+    ----------
+    df: Pandas dataframe of the raw table, see bond_data.read_table
+    group_key: list of the columns that make up the AIMS DeptFundProgAct
+
+    Returns: df indexed by RAW_KEYS with row_count, expenses, obligated, row_hash
+    -------
+    """
+    df = df.rename(columns=dict(zip(group_key, RAW_KEYS[1:])))
+    df = df.assign(fiscal_year=city_fiscal_year(df["date"]))
+
+    cols = [nullable(df[col]) for col in RAW_KEYS[1:]]
+    cols.append(nullable(df["date"].dt.strftime("%Y-%m-%d")))
+    for col in SUMS:
+        cols.append(nullable((df[col] * 100).round().astype("Int64")))
+    df["row_hash"] = [row_hash(row) for row in zip(*cols)]
+
+    return df.groupby(RAW_KEYS, dropna=False).agg(
+        row_count=("date", "size"),
+        expenses=("expenses", "sum"),
+        obligated=("obligated", "sum"),
+        row_hash=("row_hash", lambda hashes: sum(hashes) % HASH_MOD),
+    )
+
+
+def postgres_fingerprint(client, table):
+    params = {"target": table, "order": ",".join(RAW_KEYS)}
+    res = client.select(resource="rpc/raw_fingerprint", params=params)
+    df = pd.DataFrame(res, columns=RAW_KEYS + ["row_count"] + SUMS + ["row_hash"])
+    return df.set_index(RAW_KEYS)
+
+
+def postgres_totals(client, table, keys):
+    """
+    Expected fingerprint of a calculated dataset, from the totals of its raw table
+
+    Parameters
+    ----------
+    client: Postgrest client
+    table: name of the raw table the dataset is calculated from
+    keys: partition columns of the dataset, see DATASETS
+
+    Returns: df indexed by keys with row_count, expenses, obligated
+    -------
+    """
+    params = {"target": table, "order": "fiscal_year,aims_dept_prog_act"}
+    res = client.select(resource="rpc/raw_totals", params=params)
+    df = pd.DataFrame(res, columns=["fiscal_year", "aims_dept_prog_act", "row_count"] + SUMS)
+    for col in ["row_count"] + SUMS:
+        df[col] = pd.to_numeric(df[col])
+    # Socrata returns the keys as text
+    df = df.assign(**{key: nullable(df[key]).map(str, na_action="ignore") for key in keys})
+    return df.set_index(keys)[["row_count"] + SUMS]
+
+
+def socrata_fingerprint(soda, dataset_id, keys):
+    select = keys + [
+        "count(*) AS row_count",
+        "sum(expenses) AS expenses",
+        "sum(obligated) AS obligated",
+    ]
+    res = []
+    while True:
+        page = soda.get(
+            dataset_id,
+            select=", ".join(select),
+            group=", ".join(keys),
+            order=", ".join(keys),
+            limit=SOCRATA_PAGE_SIZE,
+            offset=len(res),
+        )
+        res += page
+        if len(page) < SOCRATA_PAGE_SIZE:
+            break
+    df = pd.DataFrame(res, columns=keys + ["row_count"] + SUMS)
+    for col in ["row_count"] + SUMS:
+        df[col] = pd.to_numeric(df[col])
+    return df.set_index(keys)
+
+
+def compare(expected, actual):
+    """
+    Compares two fingerprints
+
+    Parameters
+    ----------
+    expected: fingerprint of the source
+    actual: fingerprint of the destination, with the same index and columns
+
+    Returns: the partitions that do not match, with both fingerprints side by side
+    -------
+    """
+    # Counts and hashes are compared exactly, as nullable ints so they are not
+    # turned into floats by partitions that are missing on one side
+    exact = {col: "Int64" for col in expected.columns if col not in SUMS}
+    expected, actual = expected.astype(exact), actual.astype(exact)
+
+    merged = expected.join(actual, how="outer", lsuffix="_expected", rsuffix="_actual")
+    mismatched = pd.Series(False, index=merged.index)
+    for col in expected.columns:
+        left, right = merged[f"{col}_expected"], merged[f"{col}_actual"]
+        if col in SUMS:
+            mismatched |= (left.fillna(0) - right.fillna(0)).abs() > TOLERANCE
+        else:
+            # Missing partitions are null on one side which never match
+            mismatched |= ~left.eq(right).fillna(False).astype(bool)
+    return merged[mismatched]
+
+
+def resend_postgres(client, df, table, group_key, partitions):
+    """
+    Replaces only the given partitions of a raw table in postgres with our data. The
+    delete and insert are one call to api.resend_raw, which holds the load lock so a
+    load can not swap the table in between.
+    """
+    fiscal_years = city_fiscal_year(df["date"])
+    rows = pd.Series(False, index=df.index)
+    for partition in partitions:
+        fy, key = partition[0], partition[1:]
+        partition_rows = fiscal_years == fy
+        for col, value in zip(group_key, key):
+            if pd.isna(value):
+                partition_rows &= df[col].isna()
+            else:
+                partition_rows &= df[col] == value
+        rows |= partition_rows
+    rows = df[rows].assign(updated_at=str(pd.to_datetime("now", utc=True)))
+
+    partitions = pd.DataFrame(list(partitions), columns=RAW_KEYS).astype(
+        {"fiscal_year": "Int64", "department": "Int64"}
+    )
+    body = chain(
+        [
+            b'{"target":' + json.dumps(table).encode(),
+            b',"partitions":' + partitions.to_json(orient="records").encode(),
+            b',"rows":',
+        ],
+        iter_json(rows, date_format=bond_data.DATE_FORMAT_POSTGRES),
+        [b"}"],
+    )
+    bond_data.postgrest_post(client, "rpc/resend_raw", body)
+
+
+def calculate(client, dataset_id):
+    """
+    Returns: the dataframe bond_calculations.py publishes to a dataset
+    """
+    table, _ = DATASETS[dataset_id]
+    df = bond_calculations.get_data(client, table, date_field=True)
+    if dataset_id == "rrww-ybw6":
+        return bond_calculations.all_bond_expenses_obligated(df)
+    df, pdf = bond_calculations.expenses_obligated(df)
+    return df if dataset_id == "vs3t-h2aj" else pdf
+
+
+def report(name, mismatched, total):
+    print(f"{name}: {len(mismatched)} of {total} partitions do not match")
+    if len(mismatched):
+        print(mismatched.to_string())
+
+
+def main(client=None, s3_client=None, soda=None, fix=False):
+    """
+    Reconciles S3 -> postgres, then postgres -> Socrata
+
+    Returns: dict of table or dataset ID: dataframe of the mismatched partitions
+    """
+    if client is None:
+        client = Postgrest(
+            bond_data.POSTGREST_ENDPOINT,
+            token=bond_data.POSTGREST_TOKEN,
+            headers={"Prefer": "return=representation"},
+        )
+    if s3_client is None:
+        s3_client = boto3.client(
+            "s3",
+            aws_access_key_id=bond_data.AWS_ACCESS_ID,
+            aws_secret_access_key=bond_data.AWS_PASS,
+        )
+    if soda is None:
+        soda = Socrata(
+            bond_calculations.SO_WEB,
+            bond_calculations.SO_TOKEN,
+            username=bond_calculations.SO_KEY,
+            password=bond_calculations.SO_SECRET,
+            timeout=500,
+        )
+    results = {}
+
+    # 1. Microstrategy CSVs in S3 -> raw tables in postgres
+    for table in CSVS:
+        if "group_key" not in table:
+            continue
+        df = bond_data.read_table(table, s3_client)
+        expected = fingerprint_raw(df, table["group_key"])
+        actual = postgres_fingerprint(client, table["table"])
+        mismatched = compare(expected, actual)
+        report(table["table"], mismatched, len(expected))
+        if fix and len(mismatched):
+            resend_postgres(client, df, table["table"], table["group_key"], mismatched.index)
+        results[table["table"]] = mismatched
+
+    # 2. Calculated datasets -> Socrata, checked against the totals of their raw
+    # table in postgres. The datasets are only calculated to replace them
+    totals = {}
+    for dataset_id, (table, keys) in DATASETS.items():
+        if table not in totals:
+            totals[table] = postgres_totals(client, table, keys)
+        expected = totals[table]
+        if dataset_id == "jdna-s8qn":
+            # Previous fiscal years only
+            fys = expected.index.get_level_values("fiscal_year").astype(int)
+            expected = expected[fys < fys.max()]
+        actual = socrata_fingerprint(soda, dataset_id, keys)
+        mismatched = compare(expected, actual)
+        report(dataset_id, mismatched, len(expected))
+        if fix and len(mismatched):
+            df = calculate(client, dataset_id)
+            bond_calculations.df_to_socrata(soda, df, dataset_id, date_field=True)
+        results[dataset_id] = mismatched
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--fix",
+        action="store_true",
+        help="Re-send the partitions that do not match.",
+    )
+
+    args = parser.parse_args()
+
+    offline.install()
+    main(fix=args.fix)
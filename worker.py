@@ -0,0 +1,527 @@
+"""
+Long-running worker that refreshes the bond dashboard several times a day.
+
+Instead of cold starting the scripts for every refresh, the worker keeps the data
+in memory between cycles: the tables read from postgres (lookup tables, spend
+plans, appropriations, raw expenses) and the calculated cumulative ledgers. Every
+cycle it:
+
+1. Optionally extracts the trailing window of the Microstrategy reports to S3
+2. Loads only the CSVs that changed into postgres (S3 ETag or content hash)
+3. Checks the version (latest updated_at) of every postgres table it uses, only
+   the tables that changed are read again
+4. Extends the cumulative ledgers from the first date that changed instead of
+   recalculating them, then publishes only the datasets whose inputs changed since
+   they were last published. A publish that fails is retried the next cycle.
+
+The cache has a memory cap, the least recently used tables are evicted first.
+Health and metrics are served at http://127.0.0.1:WORKER_PORT/health and /metrics.
+"""
+
+import argparse
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import threading
+import time
+import traceback
+
+import pandas as pd
+
+import bond_calculations
+import bond_data
+from bond_reporting import Clients, add_worker_arguments
+from config.csv_config import CSVS
+import offline
+
+# Seconds between the start of two refresh cycles
+WORKER_INTERVAL = int(os.getenv("WORKER_INTERVAL", 3 * 60 * 60))
+# Memory cap of the in-memory tables and ledgers
+WORKER_MEMORY_MB = float(os.getenv("WORKER_MEMORY_MB", 1024))
+# Local port of the health and metrics endpoint
+WORKER_PORT = int(os.getenv("WORKER_PORT", 8080))
+
+RAW_2020 = "expenses_obligated_2020_bond_raw"
+RAW_ALL = "expenses_obligated_all_bonds_raw"
+SUMS = ["obligated", "expenses"]
+# Tables the summary tables are calculated from, with their date_field
+SUMMARY_TABLES = {
+    "bond_2020_aims_to_dashboard": False,
+    "bond_2020_baseline_spend": True,
+    "bond_2020_current_fy_spend_plan": True,
+    "bond_2020_previous_fy_spend_plan": True,
+}
+
+
+def memory_usage(df):
+    return int(df.memory_usage(deep=True).sum())
+
+
+class Cache:
+    """
+    Keeps dataframes in memory with the version of the data they were made from. The
+    least recently used entries are evicted when the total size goes over max_bytes.
+    """
+
+    def __init__(self, max_bytes, metrics):
+        self.max_bytes = max_bytes
+        self.metrics = metrics
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, name, version=None):
+        """
+        Returns the cached value, or None if it is missing or if version is given
+        and does not match the cached version
+        """
+        if name not in self.entries:
+            return None
+        cached_version, value, _ = self.entries[name]
+        if version is not None and cached_version != version:
+            return None
+        self.entries.move_to_end(name)
+        return value
+
+    def version(self, name):
+        if name not in self.entries:
+            return None
+        return self.entries[name][0]
+
+    def put(self, name, version, value):
+        self.pop(name)
+        size = memory_usage(value)
+        self.entries[name] = (version, value, size)
+        self.size += size
+        # The entry that was just added is never evicted
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            evicted, (_, _, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.metrics["evictions"] += 1
+            print(f"Evicted {evicted} from the cache ({evicted_size} bytes)")
+        self.metrics["cache_bytes"] = self.size
+        self.metrics["cache_entries"] = len(self.entries)
+
+    def pop(self, name):
+        if name in self.entries:
+            self.size -= self.entries.pop(name)[2]
+
+
+class CachedPostgrest:
+    """
+    Stands in for the postgrest client in bond_calculations.get_data so that tables
+    are only read again when their version changed. The version is the latest
+    updated_at of the table, every load replaces it.
+    """
+
+    def __init__(self, client, cache, metrics):
+        self.client = client
+        self.cache = cache
+        self.metrics = metrics
+        self.versions = {}
+
+    def new_cycle(self):
+        self.versions = {}
+
+    def version(self, table):
+        if table not in self.versions:
+            params = {"select": "updated_at", "order": "updated_at.desc", "limit": 1}
+            res = self.client.select(resource=table, params=params)
+            self.versions[table] = res[0]["updated_at"] if res else ""
+        return self.versions[table]
+
+    def get_data(self, table, date_field=False):
+        version = self.version(table)
+        df = self.cache.get(table, version)
+        if df is None:
+            self.metrics["tables_read"] += 1
+            df = bond_calculations.get_data(self.client, table, date_field)
+            self.cache.put(table, version, df)
+        else:
+            self.metrics["tables_cached"] += 1
+        # Callers add columns to the df they get
+        return df.copy()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def first_changed_date(old, new):
+    """
+    Returns the earliest date whose rows differ between two versions of a raw table,
+    or None if they are the same. Rows are compared with order independent hashes
+    per date so the tables do not need to be sorted the same way.
+    """
+    cols = [col for col in new.columns if col != "updated_at"]
+    if [col for col in old.columns if col != "updated_at"] != cols:
+        return new["date"].min()
+
+    def by_date(df):
+        hashes = pd.util.hash_pandas_object(df[cols], index=False)
+        hashes = (hashes & 0xFFFFFFFF).astype("int64")
+        return hashes.groupby(df["date"].values).agg(["sum", "size"])
+
+    old_dates, new_dates = by_date(old), by_date(new)
+    dates = old_dates.index.union(new_dates.index)
+    diff = old_dates.reindex(dates).ne(new_dates.reindex(dates)).any(axis=1)
+    if not diff.any():
+        return None
+    return diff[diff].index.min()
+
+
+def refresh_updated_at(head, raw):
+    """
+    Returns the rows of a ledger with the updated_at of the same rows in a newer raw
+    table. Rows are matched on their other columns, the filler rows have no updated_at.
+    """
+    cols = [col for col in raw.columns if col != "updated_at"]
+    real = head["updated_at"].notna().to_numpy()
+
+    # Identical rows are matched in order
+    rows = head.loc[real, cols].reset_index(drop=True)
+    rows["_n"] = rows.groupby(cols, dropna=False).cumcount()
+    new = raw[cols + ["updated_at"]].reset_index(drop=True)
+    new["_n"] = new.groupby(cols, dropna=False).cumcount()
+    updated_at = rows.merge(new, on=cols + ["_n"], how="left")["updated_at"]
+
+    head = head.copy()
+    head.loc[real, "updated_at"] = updated_at.to_numpy()
+    return head
+
+
+def extend_ledger(ledger, raw, since, keys, fill_keys, dedupe=False):
+    """
+    Recalculates the cumulative ledger only for the dates on or after since, the
+    rows before it are kept from the previous ledger with the updated_at of the new
+    raw table.
+
+    This gives the same result (up to floating point rounding) as expenses_obligated
+    and all_bond_expenses_obligated on the whole raw table as long as the groups and
+    fiscal years did not change, otherwise None is returned and the ledger must be
+    recalculated.
+
+    Parameters
+    ----------
+    ledger: previous output of the calculation
+    raw: new raw table with the aims_dept_prog_act column
+    since: first date that changed, see first_changed_date
+    keys: columns the cumulative sums are grouped by
+    fill_keys: columns other than the date that the missing rows are filled for
+    dedupe: True to only keep the first row for each group and date
+
+    Returns: the new ledger or None
+    -------
+    """
+    for col in fill_keys:
+        if set(raw[col].unique()) != set(ledger[col].unique()):
+            return None
+
+    head = refresh_updated_at(ledger[ledger["date"] < since], raw[raw["date"] < since])
+    tail = raw[raw["date"] >= since]
+    if dedupe:
+        tail = tail.drop_duplicates(subset=["aims_dept_prog_act", "date"], keep="first")
+
+    # Here, we are creating new rows for the missing rows, like the full calculation
+    levels = [raw[col].unique() for col in fill_keys] + [tail["date"].unique()]
+    fill = pd.MultiIndex.from_product(levels, names=fill_keys + ["date"]).to_frame(index=False)
+    fill = fill.merge(
+        tail[fill_keys + ["date"]].drop_duplicates(), how="left", indicator=True
+    )
+    fill = fill[fill["_merge"] == "left_only"].drop(columns="_merge")
+    fill[SUMS] = 0
+    tail = pd.concat([tail, fill], ignore_index=True)
+    tail = tail.set_index(tail["date"].rename("datetime"))
+    tail = tail.sort_index(kind="stable")
+
+    # The cumulative sums continue from the last row of each group before since
+    totals = head.groupby(keys)[["sum_obligated", "sum_expenses"]].last()
+    totals = tail[keys].join(totals, on=keys)
+    for col in SUMS:
+        tail[f"sum_{col}"] = (
+            tail.groupby(keys)[col].cumsum() + totals[f"sum_{col}"].fillna(0)
+        )
+
+    return pd.concat([head, tail[ledger.columns]])
+
+
+class Worker:
+    def __init__(
+        self, window_days=None, max_bytes=WORKER_MEMORY_MB * 1024 * 1024, clients=None
+    ):
+        self.window_days = window_days
+        # Clients can be passed in to share them with bond_reporting.py
+        self.clients = clients or Clients()
+        self.metrics = {
+            "cycles": 0,
+            "cycle_errors": 0,
+            "last_cycle_seconds": 0.0,
+            "last_cycle_timestamp": 0.0,
+            "csvs_loaded": 0,
+            "csvs_unchanged": 0,
+            "tables_read": 0,
+            "tables_cached": 0,
+            "ledgers_extended": 0,
+            "ledgers_recalculated": 0,
+            "datasets_published": 0,
+            "datasets_stale": 0,
+            "publish_errors": 0,
+            "evictions": 0,
+            "cache_bytes": 0,
+            "cache_entries": 0,
+        }
+        self.cache = Cache(max_bytes, self.metrics)
+        self.client = CachedPostgrest(self.clients.postgrest, self.cache, self.metrics)
+        # Versions of the CSVs loaded into postgres
+        self.loaded = {}
+        # Version of the rows each ledger was last calculated from
+        self.ledger_versions = {}
+        # Versions of the inputs of each dataset, wanted is what the last cycle
+        # calculated and published is only set once Socrata accepted it
+        self.wanted = {}
+        self.published = {}
+        self.last_error = None
+
+    def extract(self):
+        import microstrategy_to_s3
+
+        for report_name in microstrategy_to_s3.REPORTS:
+            args = argparse.Namespace(report_name=report_name, window_days=self.window_days)
+            microstrategy_to_s3.main(args, conn=self.clients.mstro, s3=self.clients.s3)
+
+    def load(self):
+        s3_client = self.clients.s3.meta.client
+        for table in CSVS:
+            if table["boto3"]:
+                # The ETag changes whenever the object is replaced
+                head = s3_client.head_object(
+                    Bucket="atd-microstrategy-reports", Key=table["url"]
+                )
+                version = head["ETag"]
+                if version == self.loaded.get(table["table"]):
+                    self.metrics["csvs_unchanged"] += 1
+                    continue
+                df = bond_data.read_table(table, s3_client)
+            else:
+                df = bond_data.read_table(table, s3_client)
+                version = int(pd.util.hash_pandas_object(df).sum())
+                if version == self.loaded.get(table["table"]):
+                    self.metrics["csvs_unchanged"] += 1
+                    continue
+            bond_data.to_postgres(self.clients.postgrest, df, table["table"], table["swap"])
+            self.loaded[table["table"]] = version
+            self.metrics["csvs_loaded"] += 1
+
+    def ledger(self, table, calculate, extend):
+        """
+        Returns the ledger of a raw table and the version of the rows it was calculated
+        from, which stays the same when the table is reloaded with the same rows
+        """
+        name = f"ledger:{table}"
+        version = self.client.version(table)
+        ledger = self.cache.get(name, version)
+        if ledger is not None:
+            return ledger, self.ledger_versions[table]
+
+        previous = self.cache.get(name)
+        old_raw = self.cache.get(table)
+        raw = self.client.get_data(table, date_field=True)
+
+        if previous is not None and old_raw is not None:
+            since = first_changed_date(old_raw, raw)
+            if since is None:
+                # Reloaded with the same rows
+                self.cache.put(name, version, previous)
+                return previous, self.ledger_versions[table]
+            ledger = extend(previous, raw, since)
+        else:
+            ledger = None
+
+        if ledger is not None:
+            self.metrics["ledgers_extended"] += 1
+        else:
+            ledger = calculate(raw)
+            self.metrics["ledgers_recalculated"] += 1
+        self.cache.put(name, version, ledger)
+        self.ledger_versions[table] = version
+        return ledger, version
+
+    def outdated(self, dataset_id, version):
+        """
+        Returns whether a dataset needs publishing, version identifies its inputs
+        """
+        self.wanted[dataset_id] = version
+        return self.published.get(dataset_id) != version
+
+    def publish(self, df, dataset_id, **kwargs):
+        # A failed publish does not stop the other datasets, the dataset stays stale
+        # and is published again the next cycle
+        try:
+            bond_calculations.df_to_socrata(self.clients.soda, df, dataset_id, **kwargs)
+        except Exception:
+            self.metrics["publish_errors"] += 1
+            print(traceback.format_exc())
+            return
+        self.published[dataset_id] = self.wanted[dataset_id]
+        self.metrics["datasets_published"] += 1
+
+    def stale(self):
+        """
+        Returns the datasets that are behind their inputs, ex: their publish failed
+        """
+        return sorted(
+            dataset_id
+            for dataset_id, version in self.wanted.items()
+            if self.published.get(dataset_id) != version
+        )
+
+    def calculate(self):
+        client = self.client
+        publish = self.publish
+
+        # 2020 bond ledger
+        def calculate_2020(raw):
+            return bond_calculations.expenses_obligated(raw)[0]
+
+        def extend_2020(ledger, raw, since):
+            raw["aims_dept_prog_act"] = (
+                raw["department"].astype(str) + raw["fund"] + raw["division"] + raw["group"]
+            )
+            keys = ["aims_dept_prog_act", "fiscal_year"]
+            return extend_ledger(ledger, raw, since, keys, ["fiscal_year", "aims_dept_prog_act"])
+
+        bond_data_2020, version_2020 = self.ledger(RAW_2020, calculate_2020, extend_2020)
+        if self.outdated("vs3t-h2aj", version_2020):
+            publish(bond_data_2020, "vs3t-h2aj", date_field=True, include_index=False)
+        if self.outdated("jdna-s8qn", version_2020):
+            py_bond_data_2020 = bond_data_2020[
+                bond_data_2020["fiscal_year"] < bond_data_2020["fiscal_year"].max()
+            ]
+            publish(py_bond_data_2020, "jdna-s8qn", date_field=True, include_index=False)
+
+        # All bonds ledger
+        def calculate_all(raw):
+            return bond_calculations.all_bond_expenses_obligated(raw)
+
+        def extend_all(ledger, raw, since):
+            raw["aims_dept_prog_act"] = (
+                raw["department"].astype(str)
+                + raw["fund_code"]
+                + raw["division_code"]
+                + raw["group_code"]
+            )
+            keys = ["aims_dept_prog_act"]
+            return extend_ledger(ledger, raw, since, keys, keys, dedupe=True)
+
+        all_bond_data, version_all = self.ledger(RAW_ALL, calculate_all, extend_all)
+        if self.outdated("rrww-ybw6", version_all):
+            publish(all_bond_data, "rrww-ybw6", date_field=True, include_index=False)
+
+        # Summary tables
+        version = (version_2020,) + tuple(client.version(table) for table in SUMMARY_TABLES)
+        cy_outdated = self.outdated("hq9n-d77y", version)
+        py_outdated = self.outdated("5ewg-ssu3", version)
+        if cy_outdated or py_outdated:
+            fy = bond_calculations.determine_fy(client)
+            py_summary, cy_summary = bond_calculations.summary_table(bond_data_2020, fy, client)
+            if cy_outdated:
+                publish(cy_summary, "hq9n-d77y", date_field=False, include_index=True)
+            if py_outdated:
+                publish(py_summary, "5ewg-ssu3", date_field=False, include_index=True)
+
+        # All bonds metadata
+        tables = ["all_bonds_program_names", "all_bonds_appropriations"]
+        if self.outdated("9ufs-k2md", tuple(client.version(table) for table in tables)):
+            df = client.get_data("all_bonds_program_names")
+            app = client.get_data("all_bonds_appropriations")
+            publish(bond_calculations.program_metadata(df, app), "9ufs-k2md")
+
+        if self.outdated("mri6-eexh", client.version("all_bonds_aims_to_dashboard")):
+            publish(client.get_data("all_bonds_aims_to_dashboard"), "mri6-eexh")
+
+    def cycle(self):
+        start = time.monotonic()
+        self.client.new_cycle()
+        try:
+            if self.window_days is not None:
+                self.extract()
+            self.load()
+            self.calculate()
+            stale = self.stale()
+            if stale:
+                raise RuntimeError(f"Datasets that failed to publish: {stale}")
+            self.last_error = None
+        except Exception:
+            self.metrics["cycle_errors"] += 1
+            self.last_error = traceback.format_exc()
+            print(self.last_error)
+        self.metrics["cycles"] += 1
+        self.metrics["datasets_stale"] = len(self.stale())
+        self.metrics["last_cycle_seconds"] = time.monotonic() - start
+        self.metrics["last_cycle_timestamp"] = time.time()
+
+    def run(self, interval=WORKER_INTERVAL):
+        while True:
+            start = time.monotonic()
+            self.cycle()
+            time.sleep(max(0, interval - (time.monotonic() - start)))
+
+
+def serve(worker, port=WORKER_PORT):
+    """
+    Serves /health and /metrics (Prometheus text format) on localhost in a daemon thread
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/health":
+                stale = worker.stale()
+                healthy = worker.last_error is None and not stale
+                body = json.dumps(
+                    {
+                        "status": "ok" if healthy else "error",
+                        "cycles": worker.metrics["cycles"],
+                        "last_cycle_timestamp": worker.metrics["last_cycle_timestamp"],
+                        "last_error": worker.last_error,
+                        "stale_datasets": stale,
+                    }
+                )
+                self.respond(200 if healthy else 503, "application/json", body)
+            elif self.path == "/metrics":
+                body = "".join(
+                    f"bond_worker_{name} {value}\n" for name, value in worker.metrics.items()
+                )
+                self.respond(200, "text/plain; version=0.0.4", body)
+            else:
+                self.respond(404, "text/plain", "Not found\n")
+
+        def respond(self, status, content_type, body):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.end_headers()
+            self.wfile.write(body.encode())
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(args, clients=None):
+    worker = Worker(
+        window_days=args.window_days,
+        max_bytes=args.memory_mb * 1024 * 1024,
+        clients=clients,
+    )
+    serve(worker, args.port)
+    worker.run(args.interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_worker_arguments(parser)
+    args = parser.parse_args()
+
+    offline.install()
+    main(args)